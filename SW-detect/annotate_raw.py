@@ -2,6 +2,7 @@
 # annotate_raw.py
 
 import mne
+import numpy as np
 import os
 
 def annotate_raw_data(raw, df_filtered, output_dir, suffix=''):
@@ -14,24 +15,11 @@ def annotate_raw_data(raw, df_filtered, output_dir, suffix=''):
     - output_dir: str, path to the output directory where annotated data will be saved.
     - suffix: str, additional suffix to differentiate output files.
     """
-    onsets, durations, descriptions = [], [], []
-
-    for _, row in df_filtered.iterrows():
-        onsets.append(row['Start'])  # Start time in seconds
-        durations.append(0)  # Instantaneous event
-        descriptions.append("Start")
-
-        onsets.append(row['NegPeak'])  # Time of negative peak
-        durations.append(0)
-        descriptions.append("NegPeak")
-
-        onsets.append(row['PosPeak'])  # Time of positive peak
-        durations.append(0)
-        descriptions.append("PosPeak")
-
-        onsets.append(row['End'])  # End time in seconds
-        durations.append(0)
-        descriptions.append("End")
+    # One row per wave -> Start, NegPeak, PosPeak, End per wave (row-major ravel)
+    event_cols = ['Start', 'NegPeak', 'PosPeak', 'End']
+    onsets = df_filtered[event_cols].to_numpy(dtype=np.float64).ravel()  # Times in seconds
+    durations = np.zeros(onsets.size)  # Instantaneous events
+    descriptions = np.tile(np.array(event_cols), len(df_filtered))
 
     annotations = mne.Annotations(onset=onsets, duration=durations, description=descriptions)
     raw.set_annotations(annotations)
@@ -52,19 +52,17 @@ def create_and_visualize_epochs(cleaned_events_df, output_dir, sf):
 
         # Iterate through events in pairs (stim_start and stim_end)
         logger.info("Iterating through cleaned events to create epochs.")
-        for i in range(0, len(cleaned_events_df), 2):
-            if i + 1 >= len(cleaned_events_df):
+        onset_arr = cleaned_events_df["Onset"].to_numpy()
+        for i in range(0, len(onset_arr), 2):
+            if i + 1 >= len(onset_arr):
                 logger.warning(f"Unpaired event at index {i}. Skipping.")
                 break  # Avoid index out of range
 
-            stim_start_event = cleaned_events_df.iloc[i]
-            stim_end_event = cleaned_events_df.iloc[i + 1]
-
-            stim_start = stim_start_event["Onset"]
-            stim_end = stim_end_event["Onset"]
+            stim_start = onset_arr[i]
+            stim_end = onset_arr[i + 1]
             stim_duration = stim_end - stim_start
 
-            logger.debug(f"Processing Protocol {protocol_number}: stim_start at {stim_start}s, stim_end at {stim_end}s, duration {stim_duration}s.")
+            logger.debug("Processing Protocol %s: stim_start at %ss, stim_end at %ss, duration %ss.", protocol_number, stim_start, stim_end, stim_duration)
 
             # Define original epochs
             orig_pre_start = stim_start - stim_duration
@@ -93,7 +91,7 @@ def create_and_visualize_epochs(cleaned_events_df, output_dir, sf):
                         old_post[2]
                     )
                     post_stim_epochs[-1] = new_post
-                    logger.info(f"Adjusted Protocol {old_post[2]}'s post-stim epoch by reducing {half_overlap}s to remove overlap.")
+                    logger.info("Adjusted Protocol %s's post-stim epoch by reducing %ss to remove overlap.", old_post[2], half_overlap)
                 orig_pre_start += half_overlap
                 overlaps.append({
                     'protocols': (protocol_number - 1, protocol_number),
@@ -101,7 +99,7 @@ def create_and_visualize_epochs(cleaned_events_df, output_dir, sf):
                     'overlap_start': orig_pre_start - half_overlap,
                     'overlap_end': orig_pre_start
                 })
-                logger.info(f"Overlap detected between Protocol {protocol_number - 1} and Protocol {protocol_number}: {overlap_amount}s.")
+                logger.info("Overlap detected between Protocol %s and Protocol %s: %ss.", protocol_number - 1, protocol_number, overlap_amount)
 
             pre_stim_epochs.append((orig_pre_start, orig_pre_end, protocol_number))
             stim_epochs.append((orig_stim_start, orig_stim_end, protocol_number))
@@ -200,7 +198,7 @@ def plot_epochs(pre_stim_epochs, stim_epochs, post_stim_epochs, ax, title, sf):
     - title: str, title for the plot.
     - sf: Sampling frequency (in Hz). Used to convert time from seconds to hours.
     """
-    logger.debug(f"Plotting epochs: {title}")
+    logger.debug("Plotting epochs: %s", title)
 
     def seconds_to_hours(seconds):
         return seconds / 3600.0
@@ -243,7 +241,7 @@ def plot_epochs(pre_stim_epochs, stim_epochs, post_stim_epochs, ax, title, sf):
     ax.set_yticks([])
     ax.grid(True, linestyle='--', alpha=0.5)
 
-    logger.debug(f"Completed plotting epochs: {title}")
+    logger.debug("Completed plotting epochs: %s", title)
 
 
 def plot_durations(durations, output_dir):
@@ -303,7 +301,7 @@ def calculate_durations(cleaned_events_df):
         for start, end in zip(stim_starts, stim_ends):
             duration = end - start
             durations.append(duration)
-            logger.debug(f"Calculated duration: {duration:.2f}s between {start}s and {end}s.")
+            logger.debug("Calculated duration: %.2fs between %ss and %ss.", duration, start, end)
 
         logger.info(f"Total durations calculated: {len(durations)}")
         return durations
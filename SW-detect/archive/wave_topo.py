@@ -3,6 +3,7 @@ import mne
 import pandas as pd
 import numpy as np
 import os
+from itertools import compress
 import matplotlib.pyplot as plt
 
 # List of files
@@ -31,9 +32,17 @@ files = [
 output_dir = '/Users/idohaber/Desktop/topotools_jan21'
 os.makedirs(output_dir, exist_ok=True)
 
+# Standard 10-20 positions, built once for every subject that has no montage
+STD_1020_POS = pd.DataFrame.from_dict(
+    mne.channels.make_standard_montage('standard_1020').get_positions()['ch_pos'], orient='index'
+)
+
 # Function to normalize counts using logarithmic scale
 def normalize_counts_log(counts):
-    return np.log1p(np.maximum(0, counts))  # log1p ensures no issues with zero counts
+    # Clip and log1p in place on one float32 buffer; log1p ensures no issues with zero counts
+    out = np.maximum(counts, 0, dtype=np.float32)
+    np.log1p(out, out=out)
+    return out
 
 # Function to filter electrodes with valid data
 def filter_electrodes(channel_names, counts, classification_filter):
@@ -49,8 +58,9 @@ def filter_electrodes(channel_names, counts, classification_filter):
     - filtered_channel_names: List of filtered channel names.
     - filtered_counts: Array of counts for the filtered channels.
     """
-    filtered_channel_names = [ch for ch, keep in zip(channel_names, classification_filter) if keep]
-    filtered_counts = np.array([count for count, keep in zip(counts, classification_filter) if keep])
+    classification_filter = np.asarray(classification_filter, dtype=bool)
+    filtered_channel_names = list(compress(channel_names, classification_filter))
+    filtered_counts = np.asarray(counts)[classification_filter]
     return filtered_channel_names, filtered_counts
 
 # Loop through files
@@ -70,8 +80,8 @@ for fname in files:
         print(f"CSV file not found for {fname}. Skipping...")
         continue
 
-    # Load the raw EEG data
-    raw = mne.io.read_raw_eeglab(fname, preload=True)
+    # Load the EEG header only: channel names and montage are all that is used here
+    raw = mne.io.read_raw_eeglab(fname, preload=False)
 
     # Ensure digitization points or montage is available
     if raw.info['dig'] is None:
@@ -84,28 +94,29 @@ for fname in files:
     # Exclude rows with 'Region_Classification' == 'Unclassified'
     df = df[df['Region_Classification'] != 'Unclassified']
 
-    # Split data by classification
-    overall_count = df['Channel'].value_counts()
-    stim_count = df[df['Classification'] == 'stim']['Channel'].value_counts()
-    pre_stim_count = df[df['Classification'] == 'pre-stim']['Channel'].value_counts()
-    post_stim_count = df[df['Classification'] == 'post-stim']['Channel'].value_counts()
+    # Count waves per channel and classification in one pass
+    ct = pd.crosstab(df['Channel'], df['Classification'])
+    overall_count = ct.sum(axis=1)
+    ct = ct.reindex(columns=['stim', 'pre-stim', 'post-stim'], fill_value=0)
 
     # Calculate differences
-    stim_minus_pre = stim_count.subtract(pre_stim_count, fill_value=0)
+    stim_minus_pre = ct['stim'] - ct['pre-stim']
     print(stim_minus_pre)
-    post_minus_pre = post_stim_count.subtract(pre_stim_count, fill_value=0)
+    post_minus_pre = ct['post-stim'] - ct['pre-stim']
 
     # Map counts to channels in the raw object
     channel_names = raw.info['ch_names']
-    overall_counts = np.array([overall_count.get(ch, 0) for ch in channel_names])
-    stim_minus_pre_counts = np.array([stim_minus_pre.get(ch, 0) for ch in channel_names])
+    overall_counts = overall_count.reindex(channel_names, fill_value=0).to_numpy()
+    stim_minus_pre_counts = stim_minus_pre.reindex(channel_names, fill_value=0).to_numpy()
     print(stim_minus_pre_counts)
-    post_minus_pre_counts = np.array([post_minus_pre.get(ch, 0) for ch in channel_names])
+    post_minus_pre_counts = post_minus_pre.reindex(channel_names, fill_value=0).to_numpy()
 
-    # Normalize counts using logarithmic scale
-    overall_counts_normalized = normalize_counts_log(overall_counts)
-    stim_minus_pre_counts_normalized = normalize_counts_log(stim_minus_pre_counts)
-    post_minus_pre_counts_normalized = normalize_counts_log(post_minus_pre_counts)
+    # Normalize counts using logarithmic scale (all three in one pass)
+    (overall_counts_normalized,
+     stim_minus_pre_counts_normalized,
+     post_minus_pre_counts_normalized) = normalize_counts_log(
+        np.stack([overall_counts, stim_minus_pre_counts, post_minus_pre_counts])
+    )
 
     # Create a filter for electrodes with data
     overall_filter = overall_counts > 0
@@ -124,18 +135,12 @@ for fname in files:
     # Get positions for filtered channels
     montage = raw.get_montage()
     if montage is not None:
-        pos = montage.get_positions()['ch_pos']
-        pos_filtered = np.array(
-            [pos[ch] if ch in pos else [np.nan, np.nan, np.nan] for ch in filtered_channel_names]
-        )[:, :2]  # Use only x, y for topomap plotting
+        pos_df = pd.DataFrame.from_dict(montage.get_positions()['ch_pos'], orient='index')
     else:
-        print("No montage available. Setting a standard montage.")
-        montage = mne.channels.make_standard_montage('standard_1020')
-        raw.set_montage(montage)
-        pos = montage.get_positions()['ch_pos']
-        pos_filtered = np.array(
-            [pos[ch] if ch in pos else [np.nan, np.nan, np.nan] for ch in filtered_channel_names]
-        )[:, :2]
+        print("No montage available. Using standard 10-20 positions.")
+        pos_df = STD_1020_POS
+    # Channels missing from the montage come out of the reindex as NaN rows
+    pos_filtered = pos_df.reindex(filtered_channel_names).to_numpy()[:, :2]  # Use only x, y for topomap plotting
 
     # Create topoplots
     plots = {
@@ -145,12 +150,18 @@ for fname in files:
     }
 
     for plot_name, counts in plots.items():
-        fig, ax = plt.subplots(figsize=(8, 8))
+        # 150 dpi is plenty for an 8x8 inch topomap and quarters the pixels to encode
+        fig, ax = plt.subplots(figsize=(8, 8), dpi=150)
         mne.viz.plot_topomap(counts, pos_filtered, axes=ax, sphere=None, show=False, cmap='RdBu_r', image_interp='linear')
+        for collection in ax.collections:
+            collection.set_rasterized(True)
 
-        # Save the plot with a unique name
+        # Save the plot with a unique name: render once and write the RGBA
+        # buffer directly (no bbox_inches='tight' re-render)
         output_file = os.path.join(output_dir, f"{plot_name}_{subject}_{night}.png")
-        plt.savefig(output_file, dpi=300, bbox_inches='tight')
+        fig.tight_layout()
+        fig.canvas.draw()
+        plt.imsave(output_file, np.asarray(fig.canvas.buffer_rgba()))
         plt.close(fig)
         print(f"{plot_name} topoplot saved to {output_file}")
 
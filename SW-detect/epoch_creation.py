@@ -2,13 +2,125 @@
 # epoch_creation.py
 
 import logging
+import matplotlib
+matplotlib.use('Agg')  # Headless: plots are only saved, never shown
 import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
+import numpy as np
 import os
 import pandas as pd
 
 # Create a module-level logger
 logger = logging.getLogger(__name__)
 
+# Epoch and duration overview plots are saved at a fixed 100 dpi (the figure default)
+SAVEFIG_DPI = 100
+
+# Roughly this many "P{n}" protocol labels are drawn per epoch plot; with more
+# protocols only every k-th one is labelled (they would overlap anyway)
+MAX_PROTOCOL_LABELS = 50
+
+# Coarser path simplification and chunked Agg drawing for the (possibly long) durations line
+DURATIONS_PLOT_RC = {
+    'path.simplify': True,
+    'path.simplify_threshold': 1.0,
+    'agg.path.chunksize': 10000,
+}
+# Longer duration series are decimated to this many points; markers are only drawn up to DURATIONS_MARKER_MAX
+DURATIONS_MAX_POINTS = 2000
+DURATIONS_MARKER_MAX = 500
+
+def _build_epochs(onsets):
+    """
+    Build pre-stim, stim, and post-stim epochs from sorted event onsets.
+
+    Consecutive onsets are paired as (stim start, stim end); a trailing unpaired
+    onset is ignored. Pre- and post-stim epochs span one stim duration on either
+    side of the stim epoch. Where a pre-stim epoch overlaps the previous
+    protocol's (original) post-stim epoch, the overlap is split in half between
+    the two.
+
+    Parameters:
+    - onsets: np.ndarray, sorted event onsets in seconds.
+
+    Returns:
+    - orig_pre, stim, orig_post: (n_protocols, 3) arrays of
+      (start, end, protocol) before overlap adjustment.
+    - pre, post: (n_protocols, 3) arrays after overlap adjustment
+      (stim epochs are never adjusted).
+    - overlap_amounts: (n_protocols,) array, overlap (s) between each protocol's
+      pre-stim epoch and the previous post-stim epoch (0 where none).
+    """
+    n_protocols = onsets.shape[0] // 2
+    stim_starts = onsets[0:2 * n_protocols:2]
+    stim_ends = onsets[1:2 * n_protocols:2]
+    stim_durations = stim_ends - stim_starts
+    protocol_numbers = np.arange(1, n_protocols + 1, dtype=np.float64)
+
+    orig_pre = np.column_stack([stim_starts - stim_durations, stim_starts, protocol_numbers])
+    orig_stim = np.column_stack([stim_starts, stim_ends, protocol_numbers])
+    orig_post = np.column_stack([stim_ends, stim_ends + stim_durations, protocol_numbers])
+
+    # Overlap of each pre-stim epoch with the previous (original) post-stim epoch.
+    # Every adjustment only depends on original epochs, so the sweep is branchless:
+    # non-overlapping protocols get a zero shift.
+    prev_post_stim_ends = np.concatenate(([0.0], orig_post[:, 1]))[:n_protocols]
+    overlap_amounts = np.maximum(prev_post_stim_ends - orig_pre[:, 0], 0.0)
+    half_overlaps = overlap_amounts / 2
+
+    pre = orig_pre.copy()
+    post = orig_post.copy()
+    pre[:, 0] += half_overlaps
+    post[:-1, 1] -= half_overlaps[1:]
+
+    return orig_pre, orig_stim, orig_post, pre, post, overlap_amounts
+
+
+def _to_epoch_tuples(epochs):
+    """Convert an (n, 3) epoch array to a list of (start, end, protocol) tuples."""
+    return [(start, end, int(protocol)) for start, end, protocol in epochs.tolist()]
+
+
+def _epochs_from_onsets(onsets):
+    """
+    Build epochs from sorted onsets (see _build_epochs) and record the overlaps.
+
+    Parameters:
+    - onsets: np.ndarray, sorted event onsets in seconds.
+
+    Returns:
+    - original_epochs: (pre, stim, post) lists of (start, end, protocol) tuples before overlap adjustment.
+    - adjusted_epochs: (pre, stim, post) lists of tuples after overlap adjustment.
+    - overlaps: list of dictionaries containing overlap information.
+    """
+    logger.info("Iterating through cleaned events to create epochs.")
+    if len(onsets) % 2:
+        logger.warning(f"Unpaired event at index {len(onsets) - 1}. Skipping.")
+
+    orig_pre, stim, orig_post, adj_pre, adj_post, overlap_amounts = _build_epochs(onsets)
+
+    # Record overlaps (and log the adjustments that were applied)
+    overlaps = []
+    for idx in np.flatnonzero(overlap_amounts > 0):
+        protocol_number = int(idx) + 1
+        overlap_amount = overlap_amounts[idx]
+        half_overlap = overlap_amount / 2
+        if idx > 0:
+            logger.info("Adjusted Protocol %s's post-stim epoch by reducing %ss to remove overlap.", protocol_number - 1, half_overlap)
+        overlaps.append({
+            'protocols': (protocol_number - 1, protocol_number),
+            'overlap_amount': overlap_amount,
+            'overlap_start': adj_pre[idx, 0] - half_overlap,
+            'overlap_end': adj_pre[idx, 0]
+        })
+        logger.info("Overlap detected between Protocol %s and Protocol %s: %ss.", protocol_number - 1, protocol_number, overlap_amount)
+
+    stim_epochs = _to_epoch_tuples(stim)
+    original_epochs = (_to_epoch_tuples(orig_pre), stim_epochs, _to_epoch_tuples(orig_post))
+    adjusted_epochs = (_to_epoch_tuples(adj_pre), list(stim_epochs), _to_epoch_tuples(adj_post))
+    return original_epochs, adjusted_epochs, overlaps
+
+
 def create_and_visualize_epochs(cleaned_events_df, output_dir, sf):
     """
     Create pre-stim, stim, and post-stim epochs, adjust for overlaps, and visualize.
@@ -31,85 +143,11 @@ def create_and_visualize_epochs(cleaned_events_df, output_dir, sf):
         cleaned_events_df = cleaned_events_df.sort_values(by='Onset').reset_index(drop=True)
         logger.debug("Cleaned events DataFrame sorted by 'Onset'.")
 
-        # Initialize epoch lists
-        pre_stim_epochs = []
-        stim_epochs = []
-        post_stim_epochs = []
-
-        # Protocol counter
-        protocol_number = 1
-
-        # Track the end of the previous post-stim epoch
-        prev_post_stim_end = 0
-
-        # List to record overlaps
-        overlaps = []
-
-        # Lists to store original epochs for plotting before adjustments
-        original_pre_stim_epochs = []
-        original_stim_epochs = []
-        original_post_stim_epochs = []
-
-        # Iterate through events in pairs (stim_start and stim_end)
-        logger.info("Iterating through cleaned events to create epochs.")
-        for i in range(0, len(cleaned_events_df), 2):
-            if i + 1 >= len(cleaned_events_df):
-                logger.warning(f"Unpaired event at index {i}. Skipping.")
-                break  # Avoid index out of range
-
-            stim_start_event = cleaned_events_df.iloc[i]
-            stim_end_event = cleaned_events_df.iloc[i + 1]
-
-            stim_start = stim_start_event["Onset"]
-            stim_end = stim_end_event["Onset"]
-            stim_duration = stim_end - stim_start
-
-            logger.debug(f"Processing Protocol {protocol_number}: stim_start at {stim_start}s, stim_end at {stim_end}s, duration {stim_duration}s.")
-
-            # Define original epochs
-            orig_pre_start = stim_start - stim_duration
-            orig_pre_end = stim_start
-
-            orig_stim_start = stim_start
-            orig_stim_end = stim_end
-
-            orig_post_start = stim_end
-            orig_post_end = stim_end + stim_duration
-
-            # Store original epochs
-            original_pre_stim_epochs.append((orig_pre_start, orig_pre_end, protocol_number))
-            original_stim_epochs.append((orig_stim_start, orig_stim_end, protocol_number))
-            original_post_stim_epochs.append((orig_post_start, orig_post_end, protocol_number))
-
-            # Check for overlap with previous post-stim epoch
-            overlap_amount = prev_post_stim_end - orig_pre_start
-            if overlap_amount > 0:
-                half_overlap = overlap_amount / 2
-                if post_stim_epochs:
-                    old_post = post_stim_epochs[-1]
-                    new_post = (
-                        old_post[0],
-                        old_post[1] - half_overlap,
-                        old_post[2]
-                    )
-                    post_stim_epochs[-1] = new_post
-                    logger.info(f"Adjusted Protocol {old_post[2]}'s post-stim epoch by reducing {half_overlap}s to remove overlap.")
-                orig_pre_start += half_overlap
-                overlaps.append({
-                    'protocols': (protocol_number - 1, protocol_number),
-                    'overlap_amount': overlap_amount,
-                    'overlap_start': orig_pre_start - half_overlap,
-                    'overlap_end': orig_pre_start
-                })
-                logger.info(f"Overlap detected between Protocol {protocol_number - 1} and Protocol {protocol_number}: {overlap_amount}s.")
-
-            pre_stim_epochs.append((orig_pre_start, orig_pre_end, protocol_number))
-            stim_epochs.append((orig_stim_start, orig_stim_end, protocol_number))
-            post_stim_epochs.append((orig_post_start, orig_post_end, protocol_number))
-
-            # Update the end of the previous post-stim epoch
-            prev_post_stim_end = orig_post_end
-            protocol_number += 1
+        # Build epochs from the onsets, paired as (stim_start, stim_end)
+        onsets = cleaned_events_df['Onset'].to_numpy(dtype=np.float64)
+        original_epochs, adjusted_epochs, overlaps = _epochs_from_onsets(onsets)
+        original_pre_stim_epochs, original_stim_epochs, original_post_stim_epochs = original_epochs
+        pre_stim_epochs, stim_epochs, post_stim_epochs = adjusted_epochs
 
         logger.info("Epoch creation completed. Proceeding to visualization.")
 
@@ -146,20 +184,16 @@ def visualize_epochs(original_pre, original_stim, original_post,
     """
     logger.info("Starting visualization of epochs.")
 
-    def seconds_to_hours(seconds):
-        return seconds / 3600.0
-
     try:
+        # One figure for both plots; the axes are cleared between them
+        fig, ax = plt.subplots(figsize=(15, 4))
+
         # Plot before overlap removal
         logger.debug("Plotting epochs before overlap removal.")
-        fig, ax = plt.subplots(figsize=(15, 4))
         plot_epochs(original_pre, original_stim, original_post, ax, "Before Overlap Removal", sf)
-        for overlap in overlaps:
-            ax.axvspan(
-                seconds_to_hours(overlap['overlap_start']),
-                seconds_to_hours(overlap['overlap_end']),
-                color='red', alpha=0.5, label='Overlap'
-            )
+        add_spans(ax, [(overlap['overlap_start'], overlap['overlap_end']) for overlap in overlaps],
+                  'red', 'Overlap', alpha=0.5)
+        ax.autoscale_view(scaley=False)
         # Deduplicate legend entries
         handles, labels = ax.get_legend_handles_labels()
         unique_labels = {}
@@ -167,19 +201,18 @@ def visualize_epochs(original_pre, original_stim, original_post,
             if label not in unique_labels:
                 unique_labels[label] = handle
         ax.legend(unique_labels.values(), unique_labels.keys(), loc='upper right')
-        plt.tight_layout()
+        fig.tight_layout()
         before_overlap_path = os.path.join(output_dir, "before_overlap_removal.png")
-        plt.savefig(before_overlap_path)
-        plt.close(fig)
+        fig.savefig(before_overlap_path, dpi=SAVEFIG_DPI)
         logger.info(f"Saved plot before overlap removal to {before_overlap_path}")
 
         # Plot after overlap removal
         logger.debug("Plotting epochs after overlap removal.")
-        fig, ax = plt.subplots(figsize=(15, 4))
+        ax.clear()
         plot_epochs(adjusted_pre, adjusted_stim, adjusted_post, ax, "After Overlap Removal", sf)
-        plt.tight_layout()
+        fig.tight_layout()
         after_overlap_path = os.path.join(output_dir, "after_overlap_removal.png")
-        plt.savefig(after_overlap_path)
+        fig.savefig(after_overlap_path, dpi=SAVEFIG_DPI)
         plt.close(fig)
         logger.info(f"Saved plot after overlap removal to {after_overlap_path}")
 
@@ -188,6 +221,29 @@ def visualize_epochs(original_pre, original_stim, original_post,
         raise  # Re-raise the exception to allow upstream handling
 
 
+def add_spans(ax, epochs, color, label, alpha=0.3):
+    """
+    Shade (start, end, ...) epochs given in seconds as full-height spans on ax, in hours.
+
+    One PolyCollection per call instead of one axvspan per epoch. Like axvspan,
+    x is in data units and y spans the full axes height.
+    """
+    if len(epochs) == 0:
+        return
+    bounds = np.asarray(epochs, dtype=float)[:, :2] / 3600.0
+    starts, ends = bounds[:, 0:1], bounds[:, 1:2]
+    zeros, ones = np.zeros_like(starts), np.ones_like(starts)
+    verts = np.stack([
+        np.hstack([starts, zeros]), np.hstack([starts, ones]),
+        np.hstack([ends, ones]), np.hstack([ends, zeros])
+    ], axis=1)
+    ax.add_collection(PolyCollection(
+        verts, facecolors=color, edgecolors=color, alpha=alpha, label=label,
+        transform=ax.get_xaxis_transform()
+    ), autolim=False)
+    ax.update_datalim(np.column_stack([bounds.ravel(), np.zeros(bounds.size)]), updatey=False)
+
+
 def plot_epochs(pre_stim_epochs, stim_epochs, post_stim_epochs, ax, title, sf):
     """
     Helper function to plot pre-stim, stim, and post-stim epochs on a given axis with time in hours.
@@ -200,41 +256,21 @@ def plot_epochs(pre_stim_epochs, stim_epochs, post_stim_epochs, ax, title, sf):
     - title: str, title for the plot.
     - sf: Sampling frequency (in Hz). Used to convert time from seconds to hours.
     """
-    logger.debug(f"Plotting epochs: {title}")
+    logger.debug("Plotting epochs: %s", title)
 
     def seconds_to_hours(seconds):
         return seconds / 3600.0
 
-    # Flags to check if labels have been added
-    pre_stim_label_added = False
-    stim_label_added = False
-    post_stim_label_added = False
-
-    # Plot pre-stim epochs
-    for start, end, _ in pre_stim_epochs:
-        if not pre_stim_label_added:
-            ax.axvspan(seconds_to_hours(start), seconds_to_hours(end), color='blue', alpha=0.3, label='Pre-Stim')
-            pre_stim_label_added = True
-        else:
-            ax.axvspan(seconds_to_hours(start), seconds_to_hours(end), color='blue', alpha=0.3)
-
-    # Plot stim epochs
-    for start, end, protocol in stim_epochs:
-        if not stim_label_added:
-            ax.axvspan(seconds_to_hours(start), seconds_to_hours(end), color='orange', alpha=0.3, label='Stim')
-            stim_label_added = True
-        else:
-            ax.axvspan(seconds_to_hours(start), seconds_to_hours(end), color='orange', alpha=0.3)
-        # Optionally, add protocol number
-        ax.text((seconds_to_hours(start) + seconds_to_hours(end)) / 2, 0.5, f'P{protocol}', color='black', fontsize=9, ha='center', va='bottom')
+    # Plot pre-stim, stim, and post-stim epochs
+    add_spans(ax, pre_stim_epochs, 'blue', 'Pre-Stim')
+    add_spans(ax, stim_epochs, 'orange', 'Stim')
+    add_spans(ax, post_stim_epochs, 'green', 'Post-Stim')
+    ax.autoscale_view(scaley=False)
 
-    # Plot post-stim epochs
-    for start, end, _ in post_stim_epochs:
-        if not post_stim_label_added:
-            ax.axvspan(seconds_to_hours(start), seconds_to_hours(end), color='green', alpha=0.3, label='Post-Stim')
-            post_stim_label_added = True
-        else:
-            ax.axvspan(seconds_to_hours(start), seconds_to_hours(end), color='green', alpha=0.3)
+    # Optionally, add protocol number
+    label_stride = max(1, len(stim_epochs) // MAX_PROTOCOL_LABELS)
+    for start, end, protocol in stim_epochs[::label_stride]:
+        ax.text((seconds_to_hours(start) + seconds_to_hours(end)) / 2, 0.5, f'P{protocol}', color='black', fontsize=9, ha='center', va='bottom')
 
     ax.set_title(title)
     ax.set_xlabel("Time (hours)")
@@ -243,7 +279,28 @@ def plot_epochs(pre_stim_epochs, stim_epochs, post_stim_epochs, ax, title, sf):
     ax.set_yticks([])
     ax.grid(True, linestyle='--', alpha=0.5)
 
-    logger.debug(f"Completed plotting epochs: {title}")
+    logger.debug("Completed plotting epochs: %s", title)
+
+
+def _minmax_decimate(values, max_points):
+    """
+    Indices of values to plot so that at most max_points remain.
+
+    The series is split into max_points // 2 equal buckets and each bucket keeps
+    its minimum and maximum, so out-of-range durations are never dropped.
+    """
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    n_buckets = max_points // 2
+    bucket = -(-n // n_buckets)  # ceil(n / n_buckets)
+    padded = np.full(n_buckets * bucket, np.nan)
+    padded[:n] = values
+    rows = padded.reshape(n_buckets, bucket)[:-(-n // bucket)]
+    offsets = np.arange(rows.shape[0]) * bucket
+    return np.unique(np.concatenate([
+        offsets + np.nanargmin(rows, axis=1), offsets + np.nanargmax(rows, axis=1)
+    ]))
 
 
 def plot_durations(durations, output_dir):
@@ -257,25 +314,29 @@ def plot_durations(durations, output_dir):
     logger.info("Starting to plot durations between 'stim start' and 'stim end' events.")
 
     try:
-        plt.figure(figsize=(10, 5))
-        plt.plot(durations, marker='o', linestyle='-', color='purple', label='Duration')
-        plt.axhline(y=170, color='r', linestyle='--', label='Min Duration (170s)')
-        plt.axhline(y=220, color='r', linestyle='--', label='Max Duration (220s)')
-        plt.xlabel('Stim Pair Index')
-        plt.ylabel('Duration (s)')
-        plt.title('Durations Between "stim start" and "stim end" Events')
-        # Deduplicate legend entries
-        handles, labels = plt.gca().get_legend_handles_labels()
-        unique_labels = {}
-        for handle, label in zip(handles, labels):
-            if label not in unique_labels:
-                unique_labels[label] = handle
-        plt.legend(unique_labels.values(), unique_labels.keys())
-        plt.grid(True)
-        durations_plot_path = os.path.join(output_dir, "stim_durations.png")
-        plt.tight_layout()
-        plt.savefig(durations_plot_path)
-        plt.close()
+        with plt.rc_context(DURATIONS_PLOT_RC):
+            plt.figure(figsize=(10, 5))
+            durations = np.asarray(durations, dtype=float)
+            keep = _minmax_decimate(durations, DURATIONS_MAX_POINTS)
+            marker = 'o' if len(durations) <= DURATIONS_MARKER_MAX else None
+            plt.plot(keep, durations[keep], marker=marker, linestyle='-', color='purple', label='Duration')
+            plt.axhline(y=170, color='r', linestyle='--', label='Min Duration (170s)')
+            plt.axhline(y=220, color='r', linestyle='--', label='Max Duration (220s)')
+            plt.xlabel('Stim Pair Index')
+            plt.ylabel('Duration (s)')
+            plt.title('Durations Between "stim start" and "stim end" Events')
+            # Deduplicate legend entries
+            handles, labels = plt.gca().get_legend_handles_labels()
+            unique_labels = {}
+            for handle, label in zip(handles, labels):
+                if label not in unique_labels:
+                    unique_labels[label] = handle
+            plt.legend(unique_labels.values(), unique_labels.keys())
+            plt.grid(True)
+            durations_plot_path = os.path.join(output_dir, "stim_durations.png")
+            plt.tight_layout()
+            plt.savefig(durations_plot_path, dpi=SAVEFIG_DPI)
+            plt.close()
         logger.info(f"Saved durations plot to {durations_plot_path}")
 
     except Exception as e:
@@ -296,14 +357,24 @@ def calculate_durations(cleaned_events_df):
     logger.info("Calculating durations between 'stim start' and 'stim end' events.")
 
     try:
-        stim_starts = cleaned_events_df[cleaned_events_df["Description"] == "stim start"]["Onset"].values
-        stim_ends = cleaned_events_df[cleaned_events_df["Description"] == "stim end"]["Onset"].values
-
-        durations = []
-        for start, end in zip(stim_starts, stim_ends):
-            duration = end - start
-            durations.append(duration)
-            logger.debug(f"Calculated duration: {duration:.2f}s between {start}s and {end}s.")
+        # Compare integer category codes instead of strings (no-op if already categorical)
+        descriptions = cleaned_events_df["Description"].astype("category")
+        codes = descriptions.cat.codes.to_numpy()
+        start_code, end_code = descriptions.cat.categories.get_indexer(["stim start", "stim end"])
+        onsets = cleaned_events_df["Onset"].to_numpy(dtype=np.float64)
+        # A label that never occurs has code -1, which must not match missing (NaN) descriptions
+        stim_starts = onsets[codes == start_code] if start_code >= 0 else onsets[:0]
+        stim_ends = onsets[codes == end_code] if end_code >= 0 else onsets[:0]
+
+        # Pair starts and ends in order (unmatched trailing events are dropped)
+        n_pairs = min(len(stim_starts), len(stim_ends))
+        stim_starts = stim_starts[:n_pairs]
+        stim_ends = stim_ends[:n_pairs]
+        durations = (stim_ends - stim_starts).tolist()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for start, end, duration in zip(stim_starts, stim_ends, durations):
+                logger.debug("Calculated duration: %.2fs between %ss and %ss.", duration, start, end)
 
         logger.info(f"Total durations calculated: {len(durations)}")
         return durations
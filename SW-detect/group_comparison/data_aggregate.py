@@ -1,5 +1,22 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+
+
+def _read_one(task):
+    """
+    Reads a single wave quantification CSV as an Arrow table and appends
+    the Subject, Night, and Region columns.
+    """
+    file_path, subject, night, region = task
+    table = pv.read_csv(file_path)
+    n_rows = table.num_rows
+    table = table.append_column("Subject", pa.repeat(subject, n_rows))
+    table = table.append_column("Night", pa.repeat(night, n_rows))
+    return table.append_column("Region", pa.repeat(region, n_rows))
 
 def gather_data(
     project_dir,
@@ -11,13 +28,21 @@ def gather_data(
     1. Loops over each subject and night,
     2. Looks for CSV files (csv_files) in the folder:
        project_dir/subject/night/output/Strength_{subject}_{night}_forSW/file.csv
-    3. Concatenates the data into one DataFrame,
-    4. Adds columns: Subject, Night, and Region.
+    3. Reads the files found in parallel with a thread pool,
+    4. Concatenates the data into one DataFrame,
+    5. Adds columns: Subject, Night, and Region.
     """
 
-    all_data = []
+    # Parse region from each filename once, outside the loops
+    region_map = {
+        csv_file: os.path.basename(csv_file)
+        .removeprefix("wave_quantification_")
+        .removesuffix(".csv")
+        for csv_file in csv_files
+    }
 
-    # Loop through the specified subjects and nights
+    # Build the list of (path, subject, night, region) tasks up front
+    tasks = []
     for subject in subjects:
         for night in nights:
             # For each CSV file of interest
@@ -34,28 +59,26 @@ def gather_data(
 
                 # Only proceed if the file actually exists
                 if os.path.isfile(file_path):
-                    df_temp = pd.read_csv(file_path)
-
-                    # Parse region from filename
-                    base_name = os.path.basename(csv_file)
-                    region = base_name.replace("wave_quantification_", "").replace(".csv", "")
-
-                    # Add Subject, Night, and Region columns
-                    df_temp["Subject"] = subject
-                    df_temp["Night"] = night
-                    df_temp["Region"] = region
-
-                    all_data.append(df_temp)
+                    tasks.append((file_path, subject, night, region_map[csv_file]))
                 else:
                     print(f"File not found: {file_path}")
 
+    # Read the CSVs concurrently (I/O bound, the Arrow reader releases the GIL)
+    all_data = []
+    if tasks:
+        with ThreadPoolExecutor(max_workers=min(32, len(tasks))) as executor:
+            all_data = list(executor.map(_read_one, tasks))
+
     # If no data is found, return an empty DataFrame
     if not all_data:
         print("No valid CSV files were found matching the given criteria.")
         return pd.DataFrame()
 
-    # Concatenate everything into one DataFrame
-    df_all = pd.concat(all_data, ignore_index=True)
+    # Concatenate in Arrow (no copy) and convert to pandas once. Types are inferred
+    # per file, so a column can be int64 in one CSV and double in another;
+    # "permissive" promotes them to a common type like pd.concat did.
+    table = pa.concat_tables(all_data, promote_options="permissive")
+    df_all = table.to_pandas(split_blocks=True, self_destruct=True)
     return df_all
 
 
@@ -73,6 +96,10 @@ def main():
     
     # Condition variable (e.g., "Active" or "SHAM")
     condition = "Active"
+
+    # Also write the CSV copy (aggregated_wave_data_{condition}.csv) next to the
+    # Parquet file; wave_count.py reads the Parquet, other tools may still read the CSV
+    save_csv = True
     
     # 1. Gather Data
     df_all = gather_data(project_directory, subjects, nights, csv_files)
@@ -83,10 +110,15 @@ def main():
     output_dir = os.path.join(project_directory, "Group_Analysis")
     os.makedirs(output_dir, exist_ok=True)
 
-    # 2. Save the aggregated data
-    aggregated_csv_path = os.path.join(output_dir, f"aggregated_wave_data_{condition}.csv")
-    df_all.to_csv(aggregated_csv_path, index=False)
-    print(f"Aggregated CSV saved to: {aggregated_csv_path}")
+    # 2. Save the aggregated data (Parquet is much faster to write and re-read)
+    aggregated_parquet_path = os.path.join(output_dir, f"aggregated_wave_data_{condition}.parquet")
+    df_all.to_parquet(aggregated_parquet_path, engine="pyarrow", compression="zstd", index=False)
+    print(f"Aggregated Parquet saved to: {aggregated_parquet_path}")
+
+    if save_csv:
+        aggregated_csv_path = os.path.join(output_dir, f"aggregated_wave_data_{condition}.csv")
+        df_all.to_csv(aggregated_csv_path, index=False)
+        print(f"Aggregated CSV saved to: {aggregated_csv_path}")
 
 
 if __name__ == "__main__":
@@ -1,15 +1,20 @@
 
 import os
 import pandas as pd
-import seaborn as sns
+import pyarrow.parquet as pq
+import matplotlib
+matplotlib.use('Agg')  # Headless: plots are only saved, never shown
 import matplotlib.pyplot as plt
+import seaborn as sns
+
+plt.rcParams['figure.max_open_warning'] = 0
 
 # ==================== Configuration ====================
 
-# Hardcoded list of input CSV files
+# Hardcoded list of input files (Parquet written by data_aggregate.py, or CSV)
 CSV_PATHS = [
-    '/Volumes/CSC-Ido/Analyze/Group_Analysis/aggregated_wave_data_Active.csv',
-    '/Volumes/CSC-Ido/Analyze/Group_Analysis/aggregated_wave_data_SHAM.csv'
+    '/Volumes/CSC-Ido/Analyze/Group_Analysis/aggregated_wave_data_Active.parquet',
+    '/Volumes/CSC-Ido/Analyze/Group_Analysis/aggregated_wave_data_SHAM.parquet'
 ]
 
 # Hardcoded list of output directories where plots will be saved
@@ -18,63 +23,101 @@ OUTPUT_DIRS = [
     '/Users/idohaber/Desktop/Group_output/wave_count/plots_SHAM'
 ]
 
+# Figure output: these are internal check plots, so favour fast PNG encoding
+# (raise SAVEFIG_DPI, e.g. to 300, when exporting publication figures)
+SAVEFIG_DPI = 100
+SAVEFIG_PIL_KWARGS = {'compress_level': 1, 'optimize': False}
+
+# Order in which stimulation stages are plotted
+STAGE_ORDER = ['pre-stim', 'stim', 'post-stim']
+
+# Columns actually needed by the plots below
+PLOT_COLUMNS = ['Region', 'Subject', 'Stage', 'Number_of_Waves']
+
 # ========================================================
 
-def create_subject_region_plots(df, output_dir):
+def aggregate_wave_counts(df):
+    """
+    Sums Number_of_Waves by (Region, Subject, Stage) in a single groupby pass.
+    All plot functions below work on this reduced table, so the full DataFrame
+    is only scanned once.
+    
+    Parameters:
+    - df: pandas DataFrame containing the data.
+    
+    Returns:
+    - DataFrame with columns: Region, Subject, Stage, Number_of_Waves.
+    """
+    return (
+        df.groupby(['Region', 'Subject', 'Stage'], sort=False, observed=True)['Number_of_Waves']
+        .sum()
+        .reset_index()
+    )
+
+def order_stages(df):
+    """
+    Returns a copy of df with Stage as an ordered categorical (STAGE_ORDER),
+    sorted by stage.
+    """
+    stage = pd.Categorical(df['Stage'], categories=STAGE_ORDER, ordered=True)
+    return df.assign(Stage=stage).sort_values('Stage')
+
+def annotate_bar_counts(ax):
+    """
+    Writes the height of each bar on top of it as an integer count.
+    """
+    for p in ax.patches:
+        height = p.get_height()
+        ax.annotate(
+            f'{height:.0f}',
+            (p.get_x() + p.get_width() / 2., height),
+            ha='center',
+            va='bottom',
+            xytext=(0, 5),
+            textcoords='offset points'
+        )
+
+def create_subject_region_plots(counts_df, output_dir):
     """
     Generates bar plots for each subject and each region, showing the total number of waves
     across different stimulation stages. Annotates the exact wave count on top of each bar.
     
     Parameters:
-    - df: pandas DataFrame containing the data.
+    - counts_df: DataFrame returned by aggregate_wave_counts().
     - output_dir: Directory where the plots will be saved.
     """
-    subjects = df['Subject'].unique()
-    regions = df['Region'].unique()
-    
-    for subject in subjects:
-        subject_df = df[df['Subject'] == subject]
-        for region in regions:
-            region_df = subject_df[subject_df['Region'] == region]
-            
-            if region_df.empty:
-                continue  # Skip if no data for this region and subject
-            
-            # Aggregate Number_of_Waves by Stage (sum)
-            agg_df = region_df.groupby('Stage')['Number_of_Waves'].sum().reset_index()
-            
-            # Ensure the stages are in a specific order
-            stage_order = ['pre-stim', 'stim', 'post-stim']
-            agg_df['Stage'] = pd.Categorical(agg_df['Stage'], categories=stage_order, ordered=True)
-            agg_df = agg_df.sort_values('Stage')
-            
-            # Create bar plot
-            plt.figure(figsize=(8,6))
-            ax = sns.barplot(x='Stage', y='Number_of_Waves', data=agg_df, palette='viridis')
-            
-            # Annotate each bar with the exact count
-            for p in ax.patches:
-                height = p.get_height()
-                ax.annotate(
-                    f'{height:.0f}',
-                    (p.get_x() + p.get_width() / 2., height),
-                    ha='center',
-                    va='bottom',
-                    xytext=(0, 5),
-                    textcoords='offset points'
-                )
-            
-            plt.title(f'Subject {subject} - {region}')
-            plt.xlabel('Stage')
-            plt.ylabel('Total Number of Waves')
-            plt.tight_layout()
-            
-            # Save plot
-            filename = f'subject_{subject}_{region}.png'.replace('/', '_').replace('\\', '_')
-            plt.savefig(os.path.join(output_dir, filename))
-            plt.close()
-
-def create_group_average_plots(df, output_dir):
+    # One figure is reused for every subject/region (cleared between plots)
+    fig, ax = plt.subplots(figsize=(8,6))
+    
+    for (subject, region), agg_df in counts_df.groupby(['Subject', 'Region'], sort=False, observed=True):
+        if agg_df.empty:
+            continue  # Skip if no data for this region and subject
+
+        # Number_of_Waves is already summed by Stage for this subject/region
+        agg_df = agg_df[['Stage', 'Number_of_Waves']].copy()
+
+        # Ensure the stages are in a specific order
+        agg_df = order_stages(agg_df)
+        
+        # Create bar plot
+        ax.clear()
+        sns.barplot(x='Stage', y='Number_of_Waves', data=agg_df, palette='viridis', ax=ax)
+        
+        # Annotate each bar with the exact count
+        annotate_bar_counts(ax)
+        
+        ax.set_title(f'Subject {subject} - {region}')
+        ax.set_xlabel('Stage')
+        ax.set_ylabel('Total Number of Waves')
+        fig.tight_layout()
+        
+        # Save plot
+        filename = f'subject_{subject}_{region}.png'.replace('/', '_').replace('\\', '_')
+        fig.savefig(os.path.join(output_dir, filename), dpi=SAVEFIG_DPI, pil_kwargs=SAVEFIG_PIL_KWARGS)
+    
+    plt.close(fig)
+
+def create_group_average_plots(counts_df, output_dir):
     """
     Generates group total wave count bar plots for each region, showing the sum of waves
     across all subjects for each stimulation stage. Also overlays individual subject data
@@ -82,51 +125,37 @@ def create_group_average_plots(df, output_dir):
     wave count on top of each bar.
     
     Parameters:
-    - df: pandas DataFrame containing the data.
+    - counts_df: DataFrame returned by aggregate_wave_counts().
     - output_dir: Directory where the plots will be saved.
     """
-    regions = df['Region'].unique()
+    # One figure is reused for every region (cleared between plots)
+    fig, ax = plt.subplots(figsize=(8,6))
     
-    for region in regions:
-        region_df = df[df['Region'] == region]
-        
+    for region, region_df in counts_df.groupby('Region', sort=False, observed=True):
         if region_df.empty:
             continue  # Skip if no data for this region
         
-        # Aggregate Number_of_Waves by (Subject, Stage), then sum across that subject
-        # => each row in agg_df is one subject's total waves for a given stage
-        agg_df = region_df.groupby(['Subject', 'Stage'])['Number_of_Waves'].sum().reset_index()
+        # Each row is already one subject's total waves for a given stage
+        agg_df = region_df[['Subject', 'Stage', 'Number_of_Waves']].copy()
         
         # Sum across all subjects to get group-wide total
-        group_sum = agg_df.groupby('Stage')['Number_of_Waves'].sum().reset_index()
+        group_sum = agg_df.groupby('Stage', observed=True)['Number_of_Waves'].sum().reset_index()
         
         # Ensure the stages are in a specific order
-        stage_order = ['pre-stim', 'stim', 'post-stim']
-        group_sum['Stage'] = pd.Categorical(group_sum['Stage'], categories=stage_order, ordered=True)
-        group_sum = group_sum.sort_values('Stage')
+        group_sum = order_stages(group_sum)
         
         # Also categorize the Stage in agg_df for consistent plotting
-        agg_df['Stage'] = pd.Categorical(agg_df['Stage'], categories=stage_order, ordered=True)
-        agg_df = agg_df.sort_values('Stage')
+        agg_df = order_stages(agg_df)
         
         # Create bar plot (group total)
-        plt.figure(figsize=(8,6))
-        ax = sns.barplot(
+        ax.clear()
+        sns.barplot(
             x='Stage', y='Number_of_Waves', data=group_sum,
-            palette='magma', capsize=0.1, alpha=0.8
+            palette='magma', capsize=0.1, alpha=0.8, ax=ax
         )
         
         # Annotate each bar with the exact count
-        for p in ax.patches:
-            height = p.get_height()
-            ax.annotate(
-                f'{height:.0f}',
-                (p.get_x() + p.get_width() / 2., height),
-                ha='center',
-                va='bottom',
-                xytext=(0, 5),
-                textcoords='offset points'
-            )
+        annotate_bar_counts(ax)
         
         # Overlay individual subject data as points
         sns.stripplot(
@@ -135,48 +164,38 @@ def create_group_average_plots(df, output_dir):
             jitter=True, dodge=False, ax=ax
         )
         
-        plt.title(f'Group Total Waves - {region}')
-        plt.xlabel('Stage')
-        plt.ylabel('Total Number of Waves')
-        plt.tight_layout()
+        ax.set_title(f'Group Total Waves - {region}')
+        ax.set_xlabel('Stage')
+        ax.set_ylabel('Total Number of Waves')
+        fig.tight_layout()
         
         # Save plot
         filename = f'group_total_waves_{region}.png'.replace('/', '_').replace('\\', '_')
-        plt.savefig(os.path.join(output_dir, filename))
-        plt.close()
+        fig.savefig(os.path.join(output_dir, filename), dpi=SAVEFIG_DPI, pil_kwargs=SAVEFIG_PIL_KWARGS)
+    
+    plt.close(fig)
 
-def create_overall_stage_plot(df, output_dir):
+def create_overall_stage_plot(counts_df, output_dir):
     """
     Creates a total bar graph for the number of waves across all regions,
     showing total wave counts for each stage (pre-stim, stim, post-stim).
     
     Parameters:
-    - df: pandas DataFrame containing the data.
+    - counts_df: DataFrame returned by aggregate_wave_counts().
     - output_dir: Directory where the plot will be saved.
     """
     # Sum across all subjects and all regions by stage
-    overall_sum = df.groupby('Stage')['Number_of_Waves'].sum().reset_index()
+    overall_sum = counts_df.groupby('Stage', observed=True)['Number_of_Waves'].sum().reset_index()
     
     # Ensure the stages are in a specific order
-    stage_order = ['pre-stim', 'stim', 'post-stim']
-    overall_sum['Stage'] = pd.Categorical(overall_sum['Stage'], categories=stage_order, ordered=True)
-    overall_sum = overall_sum.sort_values('Stage')
+    overall_sum = order_stages(overall_sum)
     
     # Create bar plot
     plt.figure(figsize=(8,6))
     ax = sns.barplot(x='Stage', y='Number_of_Waves', data=overall_sum, palette='Set2')
     
     # Annotate each bar with the exact count
-    for p in ax.patches:
-        height = p.get_height()
-        ax.annotate(
-            f'{height:.0f}',
-            (p.get_x() + p.get_width() / 2., height),
-            ha='center',
-            va='bottom',
-            xytext=(0, 5),
-            textcoords='offset points'
-        )
+    annotate_bar_counts(ax)
 
     plt.title('Total Waves Across All Regions')
     plt.xlabel('Stage')
@@ -185,19 +204,41 @@ def create_overall_stage_plot(df, output_dir):
     
     # Save plot
     filename = f'total_waves_all_regions.png'
-    plt.savefig(os.path.join(output_dir, filename))
+    plt.savefig(os.path.join(output_dir, filename), dpi=SAVEFIG_DPI, pil_kwargs=SAVEFIG_PIL_KWARGS)
     plt.close()
 
 def process_csv_file(csv_path, out_dir):
     """
-    Reads the CSV file, checks for missing columns, and runs all plot-generating functions.
+    Reads the aggregated data file (Parquet or CSV), checks for missing columns,
+    and runs all plot-generating functions.
     """
     # Create output directory if it doesn't exist
     os.makedirs(out_dir, exist_ok=True)
     
-    # Try reading the CSV
+    # Ensure necessary columns are present
+    required_columns = [
+        'Protocol_Number', 'Stage', 'Number_of_Waves', 'Average_Amplitude',
+        'Max_Amplitude', 'Min_Amplitude', 'Std_Amplitude', 'Subject',
+        'Night', 'Region'
+    ]
+    
+    # Validate against the header/schema first, then load only the columns
+    # the plots use instead of materializing the whole table
+    is_parquet = csv_path.endswith('.parquet')
     try:
-        df = pd.read_csv(csv_path)
+        if is_parquet:
+            available_columns = pq.read_schema(csv_path).names
+        else:
+            available_columns = pd.read_csv(csv_path, nrows=0).columns
+        missing_columns = [col for col in required_columns if col not in available_columns]
+        if missing_columns:
+            print(f"Error: The following required columns are missing from '{csv_path}': {missing_columns}")
+            return
+        
+        if is_parquet:
+            df = pd.read_parquet(csv_path, columns=PLOT_COLUMNS)
+        else:
+            df = pd.read_csv(csv_path, usecols=PLOT_COLUMNS)
     except FileNotFoundError:
         print(f"Error: The file '{csv_path}' was not found.")
         return
@@ -208,21 +249,15 @@ def process_csv_file(csv_path, out_dir):
         print(f"Error: The file '{csv_path}' could not be parsed.")
         return
     
-    # Ensure necessary columns are present
-    required_columns = [
-        'Protocol_Number', 'Stage', 'Number_of_Waves', 'Average_Amplitude',
-        'Max_Amplitude', 'Min_Amplitude', 'Std_Amplitude', 'Subject',
-        'Night', 'Region'
-    ]
-    missing_columns = [col for col in required_columns if col not in df.columns]
-    if missing_columns:
-        print(f"Error: The following required columns are missing from '{csv_path}': {missing_columns}")
-        return
+    # Low-cardinality string keys: group on category codes instead of strings
+    df['Stage'] = df['Stage'].astype('category')
+    df['Region'] = df['Region'].astype('category')
     
-    # Run all plot functions
-    create_subject_region_plots(df, out_dir)
-    create_group_average_plots(df, out_dir)
-    create_overall_stage_plot(df, out_dir)
+    # Aggregate once, then run all plot functions on the reduced table
+    counts_df = aggregate_wave_counts(df)
+    create_subject_region_plots(counts_df, out_dir)
+    create_group_average_plots(counts_df, out_dir)
+    create_overall_stage_plot(counts_df, out_dir)
     
     print(f"Plots for '{csv_path}' have been successfully saved to: {out_dir}")
 
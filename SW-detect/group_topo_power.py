@@ -11,13 +11,14 @@ Modifications:
 
 import os
 import re
-import glob
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import matplotlib.pyplot as plt
-from scipy.stats import zscore
 import mne
 import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 # --- SETTINGS --- #
 # Main directory that contains subject-level output directories.
@@ -81,25 +82,31 @@ def read_subject_condition(mapping_file, logger=None):
          subject, condition
     """
     try:
-        df = pd.read_csv(mapping_file, sep=None, engine='python')
+        # Fast path: comma-separated, parsed by the C engine
+        try:
+            df = pd.read_csv(mapping_file, dtype=str, engine='c')
+            cols = [col.strip().lower() for col in df.columns]
+            sniff = "subject" not in cols or "condition" not in cols
+        except pd.errors.ParserError:
+            sniff = True
+        if sniff:
+            # Fall back to delimiter sniffing (e.g. tab or semicolon separated)
+            df = pd.read_csv(mapping_file, sep=None, dtype=str, engine='python')
     except Exception as e:
         if logger:
             logger.error(f"Error reading {mapping_file}: {e}")
         raise
 
-    cols = [col.lower() for col in df.columns]
-    if "subject" not in cols or "condition" not in cols:
+    df.columns = df.columns.str.strip().str.lower()
+    if "subject" not in df.columns or "condition" not in df.columns:
         msg = f"Expected columns 'subject' and 'condition' in {mapping_file}."
         if logger:
             logger.error(msg)
         raise ValueError(msg)
 
-    mapping = {}
-    for _, row in df.iterrows():
-        subj = str(row["subject"]).strip()
-        cond = str(row["condition"]).strip().upper()
-        mapping[subj] = cond
-    return mapping
+    subjects = df["subject"].astype(str).str.strip()
+    conditions = df["condition"].astype(str).str.strip().str.upper()
+    return dict(zip(subjects, conditions))
 
 ##############################################################################
 # 2) READ AND Z-SCORE SUBJECT DATA (Generic)
@@ -115,39 +122,53 @@ def read_and_zscore_subject(csv_path, col_map, logger=None):
       Channel, Q1, Q4, Diff
     where the metric columns are the z-scored values.
     """
+    expected_cols = ["Channel"] + list(col_map.values())
     try:
-        df = pd.read_csv(csv_path)
+        # Parse only the needed columns, with the metrics read straight into float32
+        # (a callable usecols skips absent columns so the check below reports them)
+        df = pd.read_csv(
+            csv_path,
+            usecols=lambda col: col in expected_cols,
+            dtype={col: np.float32 for col in col_map.values()},
+            engine="c"
+        )
     except Exception as e:
         if logger:
             logger.error(f"Error reading {csv_path}: {e}")
         raise
 
-    expected_cols = ["Channel"] + list(col_map.values())
-    for col in expected_cols:
-        if col not in df.columns:
-            msg = f"Column '{col}' not found in {csv_path}."
-            if logger:
-                logger.error(msg)
-            raise ValueError(msg)
+    # One set difference (reported in expected order) instead of scanning df.columns per column
+    missing_set = set(expected_cols).difference(df.columns)
+    missing = [col for col in expected_cols if col in missing_set]
+    if missing:
+        msg = f"Columns {missing} not found in {csv_path}."
+        if logger:
+            logger.error(msg)
+        raise ValueError(msg)
     
     # Compute z-scores for each metric (across the subject's available channels)
-    df["Q1 Z"] = zscore(df[col_map["Q1"]])
-    df["Q4 Z"] = zscore(df[col_map["Q4"]])
-    df["Diff Z"] = zscore(df[col_map["Diff"]])
-    # Rename the z-scored columns to "Q1", "Q4", and "Diff" (for subsequent processing)
-    df = df.rename(columns={"Q1 Z": "Q1", "Q4 Z": "Q4", "Diff Z": "Diff"})
-    return df[["Channel", "Q1", "Q4", "Diff"]]
+    # in one pass over the (channels x 3) block
+    vals = df[[col_map["Q1"], col_map["Q4"], col_map["Diff"]]].to_numpy(dtype=np.float32)
+    z = (vals - vals.mean(axis=0)) / vals.std(axis=0)
+    return pd.DataFrame({
+        "Channel": pd.Categorical(df["Channel"]),
+        "Q1": z[:, 0],
+        "Q4": z[:, 1],
+        "Diff": z[:, 2]
+    })
 
 ##############################################################################
 # 3) EXTRACT SUBJECT ID FROM PATH
 ##############################################################################
+_NUM_RE = re.compile(r'\d+')
+
 def extract_subject_id(path, valid_subjects, logger=None):
     """
     Searches the given path for a numeric token that is in the valid_subjects set.
     Returns the subject ID as a string if found; otherwise, returns None.
     """
-    nums = re.findall(r'\d+', path)
-    for num in nums:
+    for match in _NUM_RE.finditer(path):
+        num = match.group()
         if num in valid_subjects:
             return num
     if logger:
@@ -157,7 +178,46 @@ def extract_subject_id(path, valid_subjects, logger=None):
 ##############################################################################
 # 4) LOAD ALL SUBJECTS AND GROUP BY CONDITION (for a given file type)
 ##############################################################################
-def load_group_subject_data(main_dir, subj_cond_map, csv_filename, col_map, logger=None):
+def find_power_analysis_dirs(main_dir):
+    """
+    Yields every "power_analysis" folder under main_dir.
+    Walks the tree with os.walk (os.scandir based), skipping hidden folders (as glob
+    does) and not descending into power_analysis folders, which only hold outputs.
+    """
+    for root, dirs, _ in os.walk(main_dir, followlinks=True):
+        if "power_analysis" in dirs:
+            yield os.path.join(root, "power_analysis")
+        dirs[:] = [d for d in dirs if d != "power_analysis" and not d.startswith(".")]
+
+def _load_one_subject(padir, subj_cond_map, valid_subjects, csv_filename, col_map, logger=None):
+    """
+    Loads and z-scores the CSV file in one power_analysis folder.
+    Returns (condition, subject_df), or None if the folder is skipped.
+    """
+    csv_path = os.path.join(padir, csv_filename)
+    if not os.path.exists(csv_path):
+        if logger:
+            logger.warning(f"CSV file {csv_path} not found; skipping.")
+        return None
+    subj_id = extract_subject_id(padir, valid_subjects, logger=logger)
+    if subj_id is None:
+        return None
+    condition = subj_cond_map.get(subj_id)
+    if condition is None:
+        if logger:
+            logger.warning(f"Subject ID {subj_id} not found in mapping; skipping {csv_path}.")
+        return None
+    try:
+        subj_df = read_and_zscore_subject(csv_path, col_map, logger=logger)
+        subj_df["Subject"] = pd.Categorical([subj_id] * len(subj_df))
+        subj_df["Condition"] = pd.Categorical([condition] * len(subj_df))
+    except Exception as e:
+        if logger:
+            logger.error(f"[{subj_id}] Error processing {csv_path}: {e}")
+        return None
+    return condition, subj_df
+
+def load_group_subject_data(main_dir, subj_cond_map, csv_filename, col_map, logger=None, power_dirs=None):
     """
     Recursively finds all power_analysis folders under main_dir,
     reads the CSV file (specified by csv_filename) from each,
@@ -165,75 +225,80 @@ def load_group_subject_data(main_dir, subj_cond_map, csv_filename, col_map, logg
     looks up the subject condition in subj_cond_map,
     and returns a dictionary: { condition: [subject_df, ...], ... }.
     
-    The CSV is read using the provided col_map.
+    The CSV is read using the provided col_map. Subjects are independent,
+    so their files are read concurrently with a thread pool.
+    
+    power_dirs may be passed in (from find_power_analysis_dirs) to reuse one
+    directory walk across several file types.
     """
     group_data = {}
-    pattern = os.path.join(main_dir, "**", "power_analysis")
-    power_dirs = glob.glob(pattern, recursive=True)
-    if logger:
-        logger.info(f"Found {len(power_dirs)} power_analysis directories in {main_dir}.")
+    if power_dirs is None:
+        power_dirs = list(find_power_analysis_dirs(main_dir))
+        if logger:
+            logger.info(f"Found {len(power_dirs)} power_analysis directories in {main_dir}.")
+    if not power_dirs:
+        return group_data
     valid_subjects = set(subj_cond_map.keys())
-    for padir in power_dirs:
-        csv_path = os.path.join(padir, csv_filename)
-        if not os.path.exists(csv_path):
-            if logger:
-                logger.warning(f"CSV file {csv_path} not found; skipping.")
-            continue
-        subj_id = extract_subject_id(padir, valid_subjects, logger=logger)
-        if subj_id is None:
-            continue
-        condition = subj_cond_map.get(subj_id)
-        if condition is None:
-            if logger:
-                logger.warning(f"Subject ID {subj_id} not found in mapping; skipping {csv_path}.")
-            continue
-        try:
-            subj_df = read_and_zscore_subject(csv_path, col_map, logger=logger)
-            subj_df["Subject"] = subj_id
-            subj_df["Condition"] = condition
-        except Exception as e:
-            if logger:
-                logger.error(f"Error processing {csv_path}: {e}")
-            continue
-        group_data.setdefault(condition, []).append(subj_df)
+
+    def load(padir):
+        return _load_one_subject(padir, subj_cond_map, valid_subjects, csv_filename, col_map, logger=logger)
+
+    # map() keeps the directory order, so each group's subject order is unchanged
+    with ThreadPoolExecutor(max_workers=min(32, len(power_dirs))) as executor:
+        for result in executor.map(load, power_dirs):
+            if result is None:
+                continue
+            condition, subj_df = result
+            group_data.setdefault(condition, []).append(subj_df)
     return group_data
 
 ##############################################################################
 # 5) COMBINE SUBJECTS FOR A GROUP
 ##############################################################################
-def combine_subjects(subject_dfs):
+def combine_subjects(subject_dfs, valid_channels=None):
     """
     For a list of subject DataFrames (each with columns: Channel, Q1, Q4, Diff),
     combine them by channel.
     
     For each channel that appears in any subject, average the subject z-scored
     values (using only those subjects that contain that channel).
+    If valid_channels (a set of names) is given, other channels are dropped
+    before averaging.
     
     Returns a DataFrame with columns:
          Channel, Q1, Q4, Diff
     """
-    combined = {}
-    for df in subject_dfs:
-        for _, row in df.iterrows():
-            ch = row["Channel"]
-            if ch not in combined:
-                combined[ch] = {"Q1": [], "Q4": [], "Diff": []}
-            combined[ch]["Q1"].append(row["Q1"])
-            combined[ch]["Q4"].append(row["Q4"])
-            combined[ch]["Diff"].append(row["Diff"])
-    avg_data = {"Channel": [], "Q1": [], "Q4": [], "Diff": []}
-    for ch, metrics in combined.items():
-        avg_data["Channel"].append(ch)
-        avg_data["Q1"].append(np.mean(metrics["Q1"]))
-        avg_data["Q4"].append(np.mean(metrics["Q4"]))
-        avg_data["Diff"].append(np.mean(metrics["Diff"]))
-    return pd.DataFrame(avg_data)
+    if valid_channels is not None:
+        subject_dfs = [df[df["Channel"].isin(valid_channels)] for df in subject_dfs]
+
+    # Give every subject the same Channel categories so concat keeps the
+    # categorical dtype and groupby works on integer codes
+    channel_cats = union_categoricals(
+        [df["Channel"].astype("category") for df in subject_dfs]
+    ).categories
+    subject_dfs = [
+        df.assign(Channel=pd.Categorical(df["Channel"], categories=channel_cats))
+        for df in subject_dfs
+    ]
+
+    # Stack all subjects once and average per channel (first-seen channel order)
+    big = pd.concat(subject_dfs, ignore_index=True)
+    return big.groupby("Channel", sort=False, observed=True, as_index=False)[["Q1", "Q4", "Diff"]].mean()
 
 ##############################################################################
 # 6) CREATE GROUP TOPOPLOTS (EEGLAB STYLE)
 ##############################################################################
 
 
+@lru_cache(maxsize=None)
+def _get_standard_montage(name):
+    """
+    Loads a standard montage once and returns it with a frozenset of its channel names.
+    """
+    montage = mne.channels.make_standard_montage(name)
+    return montage, frozenset(montage.ch_names)
+
+
 def plot_group_topoplots(group_df, group_name, output_dir, logger=None):
     """
     Plots group-level topomaps (Q1, Q4, Diff) using MNE's default layout.
@@ -252,18 +317,16 @@ def plot_group_topoplots(group_df, group_name, output_dir, logger=None):
     # Color scale limits (adjust as needed)
     VMIN, VMAX = -2, 2
 
-    # 1) Load the standard montage
+    # 1) Load the standard montage (cached across groups and file types)
     try:
-        montage_std = mne.channels.make_standard_montage("GSN-HydroCel-256")
+        montage_std, valid_ch = _get_standard_montage(MONTAGE_NAME)
     except Exception as e:
         if logger:
-            logger.error(f"Error loading montage GSN-HydroCel-256: {e}")
+            logger.error(f"Error loading montage {MONTAGE_NAME}: {e}")
         return
 
     # 2) Filter out excluded channels and those not in the montage
-    df_channels = group_df["Channel"].tolist()
-    valid_ch = set(montage_std.ch_names)
-    common_ch = list(set(df_channels).intersection(valid_ch) - set(EXCLUDE_CHANNELS))
+    common_ch = valid_ch.intersection(group_df["Channel"]).difference(EXCLUDE_CHANNELS)
 
     if not common_ch:
         if logger:
@@ -273,9 +336,9 @@ def plot_group_topoplots(group_df, group_name, output_dir, logger=None):
     # 3) Preserve montage order
     ordered_ch = [ch for ch in montage_std.ch_names if ch in common_ch]
 
-    # Subset the group DataFrame to those channels only, in that order
-    group_df_subset = group_df[group_df["Channel"].isin(ordered_ch)].copy()
-    group_df_subset = group_df_subset.set_index("Channel").loc[ordered_ch].reset_index()
+    # Row positions of those channels in group_df, in montage order
+    pos = {ch: i for i, ch in enumerate(group_df["Channel"])}
+    idx = np.fromiter((pos[ch] for ch in ordered_ch), dtype=np.intp, count=len(ordered_ch))
 
     # 4) Create an Info object with subset montage
     montage_positions = montage_std.get_positions()['ch_pos']
@@ -292,7 +355,7 @@ def plot_group_topoplots(group_df, group_name, output_dir, logger=None):
         ("Diff", "Difference (Q4 - Q1) (z-scored)")
     ]
     for metric_key, title in metrics:
-        data = group_df_subset[metric_key].values
+        data = group_df[metric_key].to_numpy()[idx]
 
         fig, ax = plt.subplots(figsize=(6, 5))
         # Note: older MNE versions do NOT have "show_names". Instead,
@@ -317,37 +380,48 @@ def plot_group_topoplots(group_df, group_name, output_dir, logger=None):
 
         if logger:
             logger.info(f"Saved {out_fname}")
+
+##############################################################################
 # 7) SAVE CONCATENATED SUBJECT CSV FOR DOCUMENTATION
 ##############################################################################
 def save_concatenated_csv(group_data, output_dir, file_suffix, logger=None):
     """
     For each condition (group) in group_data (a dict with lists of subject DataFrames),
-    concatenate the subject DataFrames into one DataFrame (adding subject and condition columns)
-    and save it as a CSV file in output_dir. The filename will include file_suffix.
+    write the subject DataFrames (which carry subject and condition columns) one after
+    another into a single CSV file in output_dir. The filename will include file_suffix.
     """
     for condition, subj_dfs in group_data.items():
         if not subj_dfs:
             continue
-        concat_df = pd.concat(subj_dfs, ignore_index=True)
         out_fname = os.path.join(output_dir, f"{condition}_concatenated_{file_suffix}.csv")
-        concat_df.to_csv(out_fname, index=False)
+        # Stream each subject into the file (header once) instead of building one big DataFrame
+        with open(out_fname, "w", newline="") as fh:
+            subj_dfs[0].to_csv(fh, index=False)
+            for subj_df in subj_dfs[1:]:
+                subj_df.to_csv(fh, index=False, header=False)
         if logger:
             logger.info(f"Saved concatenated CSV for {condition} to {out_fname}")
 
 ##############################################################################
 # 8) MAIN PROCESSING FUNCTION FOR A GIVEN FILE TYPE
 ##############################################################################
-def process_file_type(main_dir, csv_filename, col_map, file_suffix, logger=None):
+def process_file_type(main_dir, csv_filename, col_map, file_suffix, logger=None,
+                      subj_cond_map=None, power_dirs=None):
     """
     Processes one type of CSV file (specified by csv_filename and col_map) by:
       - Loading subject data and grouping by condition.
       - Saving concatenated subject CSVs for documentation.
       - Combining subject data within each group.
       - Plotting group-level topoplots (EEGLAB-style).
+    
+    subj_cond_map and power_dirs are read/found here unless passed in, so that
+    main() can share them between the regular and FFT passes.
     """
-    subj_cond_map = read_subject_condition(SUBJECT_CONDITION_FILE, logger=logger)
-    logger.info(f"Loaded subject condition mapping for {len(subj_cond_map)} subjects.")
-    group_data = load_group_subject_data(main_dir, subj_cond_map, csv_filename, col_map, logger=logger)
+    if subj_cond_map is None:
+        subj_cond_map = read_subject_condition(SUBJECT_CONDITION_FILE, logger=logger)
+        logger.info(f"Loaded subject condition mapping for {len(subj_cond_map)} subjects.")
+    group_data = load_group_subject_data(main_dir, subj_cond_map, csv_filename, col_map,
+                                         logger=logger, power_dirs=power_dirs)
     if not group_data:
         logger.error("No subject data loaded. Exiting processing for file type.")
         return
@@ -359,10 +433,16 @@ def process_file_type(main_dir, csv_filename, col_map, file_suffix, logger=None)
     # Save concatenated CSVs for documentation.
     save_concatenated_csv(group_data, group_out_dir, file_suffix, logger=logger)
     
+    # Channels outside the montage are never plotted, so skip averaging them
+    _, montage_channels = _get_standard_montage(MONTAGE_NAME)
+
     # For each group, combine subject data and plot.
     for condition, subj_dfs in group_data.items():
         logger.info(f"Group {condition}: {len(subj_dfs)} subject files found.")
-        combined_df = combine_subjects(subj_dfs)
+        # Only the channel and metric columns are averaged; Subject/Condition
+        # are kept for the concatenated CSV above but not carried into the concat
+        slim_dfs = [df[["Channel", "Q1", "Q4", "Diff"]] for df in subj_dfs]
+        combined_df = combine_subjects(slim_dfs, valid_channels=montage_channels)
         logger.info(f"Group {condition}: Combined data has {len(combined_df)} channels.")
         plot_group_topoplots(combined_df, condition, group_out_dir, logger=logger)
 
@@ -376,13 +456,21 @@ def main(main_output_dir):
         logger.error(f"Main output directory {main_output_dir} does not exist. Exiting.")
         return
 
+    # Read the condition mapping and walk the directory tree once for both file types
+    subj_cond_map = read_subject_condition(SUBJECT_CONDITION_FILE, logger=logger)
+    logger.info(f"Loaded subject condition mapping for {len(subj_cond_map)} subjects.")
+    power_dirs = list(find_power_analysis_dirs(main_output_dir))
+    logger.info(f"Found {len(power_dirs)} power_analysis directories in {main_output_dir}.")
+
     # Process the regular topomap data
     logger.info("Processing regular topomap data...")
-    process_file_type(main_output_dir, CSV_FILENAME_REGULAR, COL_MAP_REGULAR, "regular", logger=logger)
+    process_file_type(main_output_dir, CSV_FILENAME_REGULAR, COL_MAP_REGULAR, "regular", logger=logger,
+                      subj_cond_map=subj_cond_map, power_dirs=power_dirs)
     
     # Process the FFT topomap data
     logger.info("Processing FFT topomap data...")
-    process_file_type(main_output_dir, CSV_FILENAME_FFT, COL_MAP_FFT, "fft", logger=logger)
+    process_file_type(main_output_dir, CSV_FILENAME_FFT, COL_MAP_FFT, "fft", logger=logger,
+                      subj_cond_map=subj_cond_map, power_dirs=power_dirs)
     
     logger.info("Group topoplot processing complete.")
 
@@ -173,13 +173,7 @@ def main():
             )
 
             # Import new power analysis functions from power_analysis.py
-            from power_analysis import (
-                split_stim_epochs,
-                analyze_protocols,
-                plot_average_psd,
-                plot_topomaps,
-                get_quarters
-            )
+            from power_analysis import run_power_analysis
             from periodic_power_analysis import (
                     split_stim_epochs, analyze_protocols_irasa, 
                     plot_average_irasa_components, plot_irasa_topomaps
@@ -221,33 +215,10 @@ def main():
             # --------------------------------------------------
 
             logger.info("STEP 8.5) Running power analysis (PSD comparisons)...")
-            pre_stim_epochs, q1_stim_epochs, q4_stim_epochs, post_stim_epochs = split_stim_epochs(raw, logger=logger)
-            # Run protocol-by-protocol analysis (this function creates PSD plots per protocol and saves CSV stats)
-            analyze_protocols(raw, pre_stim_epochs, q1_stim_epochs, q4_stim_epochs,
-                              post_stim_epochs, output_dir, subject_id, subject_condition, logger)
-            # Average PSD plots:
-            # For stim epochs (difference = Q4 - Q1)
-            plot_average_psd(raw, q1_stim_epochs, q4_stim_epochs, output_dir,
-                             subject_id, subject_condition, epoch_type="stim", logger=logger)
-            # For poststim epochs (difference = Q1 - Q4) – first, split each post-stim epoch:
-            q1_post_epochs, q4_post_epochs = [], []
-            for post_epoch in post_stim_epochs:
-                q1_post, q4_post = get_quarters(post_epoch)
-                q1_post_epochs.append(q1_post)
-                q4_post_epochs.append(q4_post)
-            plot_average_psd(raw, q1_post_epochs, q4_post_epochs, output_dir,
-                             subject_id, subject_condition, epoch_type="poststim", logger=logger)
-            # Topoplots:
-            # For stim epochs:
-            plot_topomaps(raw, q1_stim_epochs, q4_stim_epochs, output_dir,
-                          epoch_type="stim", method="welch", logger=logger)
-            plot_topomaps(raw, q1_stim_epochs, q4_stim_epochs, output_dir,
-                          epoch_type="stim", method="fft", logger=logger)
-            # For poststim epochs:
-            plot_topomaps(raw, q1_post_epochs, q4_post_epochs, output_dir,
-                          epoch_type="poststim", method="welch", logger=logger)
-            plot_topomaps(raw, q1_post_epochs, q4_post_epochs, output_dir,
-                          epoch_type="poststim", method="fft", logger=logger)
+            # Protocol-by-protocol PSD plots and CSV stats, average PSD plots
+            # (stim: Q4 - Q1, poststim: Q1 - Q4) and Welch/FFT topoplots.
+            # The EEG data array is extracted from raw once for all of them.
+            run_power_analysis(raw, output_dir, subject_id, subject_condition, logger=logger)
 
 
             # 12) Analyze IRASA for periodic and aperiodic components
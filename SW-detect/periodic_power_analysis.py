@@ -143,8 +143,9 @@ def analyze_protocols_irasa(raw, q1_stim_epochs, q4_stim_epochs, post_stim_epoch
     sf = raw.info['sfreq']
     chan_list = raw.info['ch_names']
     if target_chan is None:
+        chan_set = set(chan_list)
         for ch in TARGET_CHANNELS:
-            if ch in chan_list:
+            if ch in chan_set:
                 target_chan = ch
                 break
         if target_chan is None:
@@ -296,8 +297,9 @@ def plot_average_irasa_components(raw, q1_epochs, q4_epochs, output_dir, epoch_t
     sf = raw.info['sfreq']
     chan_list = raw.info['ch_names']
     if target_chan is None:
+        chan_set = set(chan_list)
         for ch in TARGET_CHANNELS:
-            if ch in chan_list:
+            if ch in chan_set:
                 target_chan = ch
                 break
         if target_chan is None:
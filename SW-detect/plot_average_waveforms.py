@@ -25,14 +25,14 @@ def plot_waveforms(raw, df_filtered, sf, output_dir, suffix=''):
     for stim_condition in df_filtered['Classification'].unique():
         condition_data = df_filtered[df_filtered['Classification'] == stim_condition]
         waveforms = []
-        for _, row in condition_data.iterrows():
-            start_sample = int(row['Start'] * sf)
+        for start, channel in condition_data[['Start', 'Channel']].itertuples(index=False, name=None):
+            start_sample = int(start * sf)
             end_sample = start_sample + n_samples  # Ensure fixed length
 
             if end_sample > raw.n_times:
                 continue  # Skip if beyond data length
 
-            channel_idx = raw.ch_names.index(row['Channel'])
+            channel_idx = raw.ch_names.index(channel)
             waveform = raw.get_data(picks=[channel_idx], start=start_sample, stop=end_sample).flatten()
 
             waveform_uV = waveform * 1e6  # Convert from V to μV
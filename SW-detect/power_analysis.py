@@ -2,6 +2,7 @@
 # power_analysis.py
 
 import os
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import mne
@@ -9,6 +10,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 import antropy as ant
 
+from mne.parallel import parallel_func
 from mne.time_frequency import psd_array_welch
 
 matplotlib.use('Agg')
@@ -28,7 +30,13 @@ ENTRAINMENT_BANDS = [
     [0.5, 2],
     [0.5, 4]
 ]
+# Lowest and highest frequency covered by any entrainment band
+ENTRAINMENT_SPAN = (min(lo for lo, _ in ENTRAINMENT_BANDS), max(hi for _, hi in ENTRAINMENT_BANDS))
 TARGET_CHANNELS = ['E37', 'E33', 'E32', 'E31', 'E25', 'E18', 'E28', 'E11']
+TARGET_CHANNEL_SET = frozenset(TARGET_CHANNELS)
+# Per-subject diagnostic PNGs (two-line PSDs, topomaps) are readable at 80 dpi
+# (raise SAVEFIG_DPI, e.g. to 300, when exporting publication figures)
+SAVEFIG_DPI = 80
 
 ###############################################################################
 # Helper: Split an epoch into Q1 and Q4
@@ -45,6 +53,175 @@ def get_quarters(epoch_tuple):
     return ((start, start + quarter, prot_num),
             (end - quarter, end, prot_num))
 
+###############################################################################
+# Helper: Permutation entropy of a Q1/Q4 pair
+###############################################################################
+def _perm_entropy_pair(q1_data, q4_data):
+    """
+    Normalized order-3 permutation entropy of Q1 and Q4.
+    Q1 and Q4 of a block have the same length, so both are passed to antropy
+    as one (2, n_times) array (vectorized 2-D path, antropy >= 0.2.2).
+    """
+    if len(q1_data) == len(q4_data):
+        ent = ant.perm_entropy(np.vstack((q1_data, q4_data)), order=3, delay=1, normalize=True)
+        return float(ent[0]), float(ent[1])
+    return (ant.perm_entropy(q1_data, order=3, delay=1, normalize=True),
+            ant.perm_entropy(q4_data, order=3, delay=1, normalize=True))
+
+###############################################################################
+# Helper: FFT-based PSD
+###############################################################################
+def _fft_psd(x, sf):
+    """
+    One-sided periodogram (uV²/Hz) along the last axis of x.
+    Returns (freqs, psd).
+    """
+    N = x.shape[-1]
+    spec = np.fft.rfft(x, axis=-1)
+    psd = spec.real * spec.real
+    psd += spec.imag * spec.imag
+    psd *= _fft_psd_scale(N, sf)
+    return _rfftfreq(N, sf), psd
+
+@lru_cache(maxsize=32)
+def _fft_psd_scale(N, sf):
+    """
+    Cached per-bin periodogram scale: 1/(sf*N), doubled for every bin except
+    the first and last (one-sided spectrum).
+    """
+    scale = np.full(N // 2 + 1, 2.0 / (sf * N))
+    scale[0] = scale[-1] = 1.0 / (sf * N)
+    scale.flags.writeable = False
+    return scale
+
+@lru_cache(maxsize=32)
+def _rfftfreq(N, sf):
+    """
+    Cached np.fft.rfftfreq(N, 1/sf) (read-only; quarters of a recording share few lengths).
+    """
+    freqs = np.fft.rfftfreq(N, d=1/sf)
+    freqs.flags.writeable = False
+    return freqs
+
+def _band_bounds(freqs, lo, hi):
+    """
+    (start, stop) slice bounds of the bins of the ascending freqs that fall in
+    [lo, hi] Hz; start == stop when the band holds no bin.
+    """
+    return (int(np.searchsorted(freqs, lo, side='left')),
+            int(np.searchsorted(freqs, hi, side='right')))
+
+@lru_cache(maxsize=256)
+def _fft_band_bounds(N, sf, lo, hi):
+    """
+    Cached _band_bounds of the rfft bins of an N-sample signal.
+    """
+    return _band_bounds(_rfftfreq(N, sf), lo, hi)
+
+def _fft_psd_pair(q1_data, q4_data, sf):
+    """
+    FFT PSDs of Q1 and Q4. Equal-length quarters (the usual case) are
+    transformed together in one batched rfft.
+    Returns (freqs, psd_q1, psd_q4); freqs are those of Q1.
+    """
+    if len(q1_data) == len(q4_data):
+        freqs, psd = _fft_psd(np.vstack((q1_data, q4_data)), sf)
+        return freqs, psd[0], psd[1]
+    freqs, psd_q1 = _fft_psd(q1_data, sf)
+    _, psd_q4 = _fft_psd(q4_data, sf)
+    return freqs, psd_q1, psd_q4
+
+###############################################################################
+# Helper: Welch PSD of a Q1/Q4 pair
+###############################################################################
+def _welch_psd_pair(q1_data, q4_data, sf, fmin, fmax):
+    """
+    Welch PSDs (n_fft=FIXED_NFFT) of Q1 and Q4. Equal-length quarters are
+    stacked into one (2, n_times) array and sent through a single call.
+    Returns (freqs, psd_q1, psd_q4).
+    """
+    if len(q1_data) == len(q4_data):
+        psd, freqs = psd_array_welch(np.vstack((q1_data, q4_data)), sfreq=sf,
+                                     fmin=fmin, fmax=fmax, n_fft=FIXED_NFFT, verbose=False)
+        return freqs, psd[0], psd[1]
+    psd_q1, freqs = psd_array_welch(q1_data[np.newaxis, :], sfreq=sf,
+                                    fmin=fmin, fmax=fmax, n_fft=FIXED_NFFT, verbose=False)
+    psd_q4, _ = psd_array_welch(q4_data[np.newaxis, :], sfreq=sf,
+                                fmin=fmin, fmax=fmax, n_fft=FIXED_NFFT, verbose=False)
+    return freqs, psd_q1[0], psd_q4[0]
+
+###############################################################################
+# Helper: float32 copies for plotting
+###############################################################################
+def _f32(x):
+    """
+    float32 view/copy of x for matplotlib and topomap interpolation;
+    plots do not need float64 precision.
+    """
+    return np.asarray(x).astype(np.float32, copy=False)
+
+###############################################################################
+# Helper: Mean signal over the target channels
+###############################################################################
+def get_target_signal(raw, data=None, logger=None):
+    """
+    Average (in uV) across the TARGET_CHANNELS present in raw, for the whole
+    recording; falls back to the first channel if none is present.
+    Epochs are then plain slices of this 1-D signal.
+    Without data, only the target channels are read from raw.
+    """
+    available_indices = [i for i, ch in enumerate(raw.info['ch_names']) if ch in TARGET_CHANNEL_SET]
+    if not available_indices:
+        if logger:
+            logger.warning("No target channels found. Using first channel as fallback.")
+        available_indices = [0]
+    if data is None:
+        return np.mean(raw.get_data(picks=available_indices, units='uV'), axis=0)
+    return np.mean(data[available_indices], axis=0)
+
+###############################################################################
+# Helper: All-channel block of samples
+###############################################################################
+def _get_block(raw, data, start, stop):
+    """
+    (n_channels, stop - start) block in uV: a view of data when it is given,
+    otherwise only these samples are read from raw (the whole recording is
+    never materialized).
+    """
+    if data is not None:
+        return data[:, start:stop]
+    return raw.get_data(units='uV', start=start, stop=stop)
+
+###############################################################################
+# Helper: Q1/Q4 PSD comparison plot on a reused figure
+###############################################################################
+def _plot_psd_comparison(fig, ax, freqs, psd_q1, psd_q4, labels, colors, band, fmin, fmax, title, path):
+    """
+    Clears ax and draws the Q1/Q4 PSD comparison for one protocol, then saves fig to path.
+    """
+    ax.clear()
+    ax.plot(_f32(freqs), _f32(psd_q1), label=labels[0], color=colors[0])
+    ax.plot(_f32(freqs), _f32(psd_q4), label=labels[1], color=colors[1])
+    ax.axvline(x=1.0, color="green", linestyle="--", label="1 Hz")
+    ax.axvspan(band[0], band[1], color="gray", alpha=0.3, label=f"{band[0]}–{band[1]} Hz")
+    ax.set_xlabel("Frequency (Hz)")
+    ax.set_ylabel("Power (uV²/Hz)")
+    ax.set_title(title)
+    ax.legend()
+    ax.set_xlim(fmin, fmax)
+    fig.tight_layout()
+    fig.savefig(path, dpi=SAVEFIG_DPI)
+
+###############################################################################
+# Helper: Shared colour limits of two topomaps
+###############################################################################
+def _common_vlim(a, b):
+    """
+    (nanmin, nanmax) over both arrays, from a single concatenated buffer.
+    """
+    both = np.concatenate((a, b))
+    return np.nanmin(both), np.nanmax(both)
+
 ###############################################################################
 # 1) SPLIT STIMULATION EPOCHS
 ###############################################################################
@@ -104,7 +281,9 @@ def analyze_protocols(raw,
                       output_dir,
                       subject_id=None,
                       condition=None,
-                      logger=None):
+                      logger=None,
+                      data=None,
+                      target_signal=None):
     """
     For each protocol:
       - For STIM epochs, compute PSD using Welch and FFT (averaging across TARGET_CHANNELS)
@@ -114,14 +293,12 @@ def analyze_protocols(raw,
       - For each protocol, plot the PSD comparisons (both Welch and FFT) and save protocol-level
         statistics to CSV files.
       - Finally, create bar plots summarizing the average differences across STIM protocols.
+    data: optional raw.get_data(units='uV') array, so callers can extract it once.
+    target_signal: optional precomputed get_target_signal() output.
     """
     sf = raw.info['sfreq']
-    data = raw.get_data(units='uV')
-    available_indices = [i for i, ch in enumerate(raw.info['ch_names']) if ch in TARGET_CHANNELS]
-    if not available_indices:
-        if logger:
-            logger.warning("No target channels found. Using first channel as fallback.")
-        available_indices = [0]
+    if target_signal is None:
+        target_signal = get_target_signal(raw, data=data, logger=logger)
 
     pa_dir = os.path.join(output_dir, "power_analysis")
     os.makedirs(pa_dir, exist_ok=True)
@@ -129,46 +306,34 @@ def analyze_protocols(raw,
     # Use the first entrainment band for protocol-level stats.
     band = ENTRAINMENT_BANDS[0]
 
+    # One figure per PSD method, cleared and reused for every protocol plot.
+    fig_welch, ax_welch = plt.subplots(figsize=(10, 6))
+    fig_fft, ax_fft = plt.subplots(figsize=(10, 6))
+
     # --- STIM Analysis (difference = Q4 - Q1) ---
     protocol_stats_stim = []
     for prot_idx, (q1_ep, q4_ep) in enumerate(zip(q1_stim_epochs, q4_stim_epochs)):
         prot_num = prot_idx + 1
         q1_start, q1_end, _ = q1_ep
         q4_start, q4_end, _ = q4_ep
-        q1_data = np.mean(data[available_indices, q1_start:q1_end], axis=0)
-        q4_data = np.mean(data[available_indices, q4_start:q4_end], axis=0)
+        q1_data = target_signal[q1_start:q1_end]
+        q4_data = target_signal[q4_start:q4_end]
         try:
-            psd_q1, freqs = psd_array_welch(q1_data[np.newaxis, :], sfreq=sf,
-                                            fmin=fmin, fmax=fmax, n_fft=FIXED_NFFT, verbose=False)
-            psd_q4, _ = psd_array_welch(q4_data[np.newaxis, :], sfreq=sf,
-                                        fmin=fmin, fmax=fmax, n_fft=FIXED_NFFT, verbose=False)
+            freqs, psd_q1, psd_q4 = _welch_psd_pair(q1_data, q4_data, sf, fmin, fmax)
         except Exception as e:
             if logger:
                 logger.warning(f"Stim Protocol {prot_num}: Error computing Welch PSD: {e}. Skipping protocol.")
             continue
-        psd_q1 = psd_q1[0]
-        psd_q4 = psd_q4[0]
-        band_idx = np.where((freqs >= band[0]) & (freqs <= band[1]))[0]
-        power_q1 = np.mean(psd_q1[band_idx]) if len(band_idx) else np.nan
-        power_q4 = np.mean(psd_q4[band_idx]) if len(band_idx) else np.nan
+        lo_i, hi_i = _band_bounds(freqs, band[0], band[1])
+        power_q1 = psd_q1[lo_i:hi_i].mean() if hi_i > lo_i else np.nan
+        power_q4 = psd_q4[lo_i:hi_i].mean() if hi_i > lo_i else np.nan
         diff_power = power_q4 - power_q1
-        ent_q1 = ant.perm_entropy(q1_data, order=3, delay=1, normalize=True)
-        ent_q4 = ant.perm_entropy(q4_data, order=3, delay=1, normalize=True)
+        ent_q1, ent_q4 = _perm_entropy_pair(q1_data, q4_data)
         diff_ent = ent_q4 - ent_q1
-        N_q1 = len(q1_data)
-        N_q4 = len(q4_data)
-        fft_q1 = np.fft.rfft(q1_data)
-        fft_freqs = np.fft.rfftfreq(N_q1, d=1/sf)
-        fft_psd_q1 = (np.abs(fft_q1)**2) / (sf * N_q1)
-        if N_q1 > 1:
-            fft_psd_q1[1:-1] *= 2
-        fft_q4 = np.fft.rfft(q4_data)
-        fft_psd_q4 = (np.abs(fft_q4)**2) / (sf * N_q4)
-        if N_q4 > 1:
-            fft_psd_q4[1:-1] *= 2
-        band_idx_fft = np.where((fft_freqs >= band[0]) & (fft_freqs <= band[1]))[0]
-        power_fft_q1 = np.mean(fft_psd_q1[band_idx_fft]) if len(band_idx_fft) else np.nan
-        power_fft_q4 = np.mean(fft_psd_q4[band_idx_fft]) if len(band_idx_fft) else np.nan
+        fft_freqs, fft_psd_q1, fft_psd_q4 = _fft_psd_pair(q1_data, q4_data, sf)
+        lo_fft, hi_fft = _fft_band_bounds(len(q1_data), sf, band[0], band[1])
+        power_fft_q1 = fft_psd_q1[lo_fft:hi_fft].mean() if hi_fft > lo_fft else np.nan
+        power_fft_q4 = fft_psd_q4[lo_fft:hi_fft].mean() if hi_fft > lo_fft else np.nan
         diff_power_fft = power_fft_q4 - power_fft_q1
         protocol_stats_stim.append({
             "protocol": prot_num,
@@ -187,32 +352,14 @@ def analyze_protocols(raw,
             "diff_power_fft": diff_power_fft
         })
         # Plot PSD comparisons for this stim protocol.
-        fig, ax = plt.subplots(figsize=(10, 6))
-        ax.plot(freqs, psd_q1, label="Q1 PSD (Welch)", color="orange")
-        ax.plot(freqs, psd_q4, label="Q4 PSD (Welch)", color="red")
-        ax.axvline(x=1.0, color="green", linestyle="--", label="1 Hz")
-        ax.axvspan(band[0], band[1], color="gray", alpha=0.3, label=f"{band[0]}–{band[1]} Hz")
-        ax.set_xlabel("Frequency (Hz)")
-        ax.set_ylabel("Power (uV²/Hz)")
-        ax.set_title(f"Stim Protocol {prot_num}: Welch PSD (Q4-Q1)")
-        ax.legend()
-        ax.set_xlim(fmin, fmax)
-        fig.tight_layout()
-        fig.savefig(os.path.join(pa_dir, f"stim_protocol_{prot_num}_psd_comparison.png"))
-        plt.close(fig)
-        fig, ax = plt.subplots(figsize=(10, 6))
-        ax.plot(fft_freqs, fft_psd_q1, label="Q1 FFT PSD", color="blue")
-        ax.plot(fft_freqs, fft_psd_q4, label="Q4 FFT PSD", color="purple")
-        ax.axvline(x=1.0, color="green", linestyle="--", label="1 Hz")
-        ax.axvspan(band[0], band[1], color="gray", alpha=0.3, label=f"{band[0]}–{band[1]} Hz")
-        ax.set_xlabel("Frequency (Hz)")
-        ax.set_ylabel("Power (uV²/Hz)")
-        ax.set_title(f"Stim Protocol {prot_num}: FFT PSD (Q4-Q1)")
-        ax.legend()
-        ax.set_xlim(fmin, fmax)
-        fig.tight_layout()
-        fig.savefig(os.path.join(pa_dir, f"stim_protocol_{prot_num}_fft_psd_comparison.png"))
-        plt.close(fig)
+        _plot_psd_comparison(fig_welch, ax_welch, freqs, psd_q1, psd_q4,
+                             ("Q1 PSD (Welch)", "Q4 PSD (Welch)"), ("orange", "red"),
+                             band, fmin, fmax, f"Stim Protocol {prot_num}: Welch PSD (Q4-Q1)",
+                             os.path.join(pa_dir, f"stim_protocol_{prot_num}_psd_comparison.png"))
+        _plot_psd_comparison(fig_fft, ax_fft, fft_freqs, fft_psd_q1, fft_psd_q4,
+                             ("Q1 FFT PSD", "Q4 FFT PSD"), ("blue", "purple"),
+                             band, fmin, fmax, f"Stim Protocol {prot_num}: FFT PSD (Q4-Q1)",
+                             os.path.join(pa_dir, f"stim_protocol_{prot_num}_fft_psd_comparison.png"))
         if logger:
             logger.info(f"Stim Protocol {prot_num}: Welch diff={diff_power:.4f}, FFT diff={diff_power_fft:.4f}, Entropy diff={diff_ent:.4f}")
 
@@ -231,7 +378,7 @@ def analyze_protocols(raw,
         ax.set_title("Average Welch PSD Difference Across STIM Protocols")
         ax.legend()
         fig.tight_layout()
-        fig.savefig(os.path.join(pa_dir, "welch_band_power_diff_across_protocols.png"))
+        fig.savefig(os.path.join(pa_dir, "welch_band_power_diff_across_protocols.png"), dpi=SAVEFIG_DPI)
         plt.close(fig)
         fig, ax = plt.subplots(figsize=(8, 5))
         ax.bar(prot_nums, fft_diffs, color="purple", alpha=0.7)
@@ -241,7 +388,7 @@ def analyze_protocols(raw,
         ax.set_title("Average FFT PSD Difference Across STIM Protocols")
         ax.legend()
         fig.tight_layout()
-        fig.savefig(os.path.join(pa_dir, "fft_band_power_diff_across_protocols.png"))
+        fig.savefig(os.path.join(pa_dir, "fft_band_power_diff_across_protocols.png"), dpi=SAVEFIG_DPI)
         plt.close(fig)
         if logger:
             logger.info("Saved bar plots for average differences across STIM protocols.")
@@ -258,40 +405,24 @@ def analyze_protocols(raw,
         prot_num = prot_idx + 1
         q1_start, q1_end, _ = q1_ep
         q4_start, q4_end, _ = q4_ep
-        q1_data = np.mean(data[available_indices, q1_start:q1_end], axis=0)
-        q4_data = np.mean(data[available_indices, q4_start:q4_end], axis=0)
+        q1_data = target_signal[q1_start:q1_end]
+        q4_data = target_signal[q4_start:q4_end]
         try:
-            psd_q1, freqs = psd_array_welch(q1_data[np.newaxis, :], sfreq=sf,
-                                            fmin=fmin, fmax=fmax, n_fft=FIXED_NFFT, verbose=False)
-            psd_q4, _ = psd_array_welch(q4_data[np.newaxis, :], sfreq=sf,
-                                        fmin=fmin, fmax=fmax, n_fft=FIXED_NFFT, verbose=False)
+            freqs, psd_q1, psd_q4 = _welch_psd_pair(q1_data, q4_data, sf, fmin, fmax)
         except Exception as e:
             if logger:
                 logger.warning(f"Post-Stim Protocol {prot_num}: Error computing Welch PSD: {e}. Skipping protocol.")
             continue
-        psd_q1 = psd_q1[0]
-        psd_q4 = psd_q4[0]
-        band_idx = np.where((freqs >= band[0]) & (freqs <= band[1]))[0]
-        power_q1 = np.mean(psd_q1[band_idx]) if len(band_idx) else np.nan
-        power_q4 = np.mean(psd_q4[band_idx]) if len(band_idx) else np.nan
+        lo_i, hi_i = _band_bounds(freqs, band[0], band[1])
+        power_q1 = psd_q1[lo_i:hi_i].mean() if hi_i > lo_i else np.nan
+        power_q4 = psd_q4[lo_i:hi_i].mean() if hi_i > lo_i else np.nan
         diff_power = power_q1 - power_q4   # For post-stim, difference = Q1 - Q4.
-        ent_q1 = ant.perm_entropy(q1_data, order=3, delay=1, normalize=True)
-        ent_q4 = ant.perm_entropy(q4_data, order=3, delay=1, normalize=True)
+        ent_q1, ent_q4 = _perm_entropy_pair(q1_data, q4_data)
         diff_ent = ent_q1 - ent_q4
-        N_q1 = len(q1_data)
-        N_q4 = len(q4_data)
-        fft_q1 = np.fft.rfft(q1_data)
-        fft_freqs = np.fft.rfftfreq(N_q1, d=1/sf)
-        fft_psd_q1 = (np.abs(fft_q1)**2) / (sf * N_q1)
-        if N_q1 > 1:
-            fft_psd_q1[1:-1] *= 2
-        fft_q4 = np.fft.rfft(q4_data)
-        fft_psd_q4 = (np.abs(fft_q4)**2) / (sf * N_q4)
-        if N_q4 > 1:
-            fft_psd_q4[1:-1] *= 2
-        band_idx_fft = np.where((fft_freqs >= band[0]) & (fft_freqs <= band[1]))[0]
-        power_fft_q1 = np.mean(fft_psd_q1[band_idx_fft]) if len(band_idx_fft) else np.nan
-        power_fft_q4 = np.mean(fft_psd_q4[band_idx_fft]) if len(band_idx_fft) else np.nan
+        fft_freqs, fft_psd_q1, fft_psd_q4 = _fft_psd_pair(q1_data, q4_data, sf)
+        lo_fft, hi_fft = _fft_band_bounds(len(q1_data), sf, band[0], band[1])
+        power_fft_q1 = fft_psd_q1[lo_fft:hi_fft].mean() if hi_fft > lo_fft else np.nan
+        power_fft_q4 = fft_psd_q4[lo_fft:hi_fft].mean() if hi_fft > lo_fft else np.nan
         diff_power_fft = power_fft_q1 - power_fft_q4
         protocol_stats_post.append({
             "protocol": prot_num,
@@ -309,34 +440,18 @@ def analyze_protocols(raw,
             "fft_psd_q4": fft_psd_q4,
             "diff_power_fft": diff_power_fft
         })
-        fig, ax = plt.subplots(figsize=(10, 6))
-        ax.plot(freqs, psd_q1, label="Q1 PSD (Welch)", color="orange")
-        ax.plot(freqs, psd_q4, label="Q4 PSD (Welch)", color="red")
-        ax.axvline(x=1.0, color="green", linestyle="--", label="1 Hz")
-        ax.axvspan(band[0], band[1], color="gray", alpha=0.3, label=f"{band[0]}–{band[1]} Hz")
-        ax.set_xlabel("Frequency (Hz)")
-        ax.set_ylabel("Power (uV²/Hz)")
-        ax.set_title(f"Post-Stim Protocol {prot_num}: Welch PSD (Q1-Q4)")
-        ax.legend()
-        ax.set_xlim(fmin, fmax)
-        fig.tight_layout()
-        fig.savefig(os.path.join(pa_dir, f"poststim_protocol_{prot_num}_psd_comparison.png"))
-        plt.close(fig)
-        fig, ax = plt.subplots(figsize=(10, 6))
-        ax.plot(fft_freqs, fft_psd_q1, label="Q1 FFT PSD", color="blue")
-        ax.plot(fft_freqs, fft_psd_q4, label="Q4 FFT PSD", color="purple")
-        ax.axvline(x=1.0, color="green", linestyle="--", label="1 Hz")
-        ax.axvspan(band[0], band[1], color="gray", alpha=0.3, label=f"{band[0]}–{band[1]} Hz")
-        ax.set_xlabel("Frequency (Hz)")
-        ax.set_ylabel("Power (uV²/Hz)")
-        ax.set_title(f"Post-Stim Protocol {prot_num}: FFT PSD (Q1-Q4)")
-        ax.legend()
-        ax.set_xlim(fmin, fmax)
-        fig.tight_layout()
-        fig.savefig(os.path.join(pa_dir, f"poststim_protocol_{prot_num}_fft_psd_comparison.png"))
-        plt.close(fig)
+        _plot_psd_comparison(fig_welch, ax_welch, freqs, psd_q1, psd_q4,
+                             ("Q1 PSD (Welch)", "Q4 PSD (Welch)"), ("orange", "red"),
+                             band, fmin, fmax, f"Post-Stim Protocol {prot_num}: Welch PSD (Q1-Q4)",
+                             os.path.join(pa_dir, f"poststim_protocol_{prot_num}_psd_comparison.png"))
+        _plot_psd_comparison(fig_fft, ax_fft, fft_freqs, fft_psd_q1, fft_psd_q4,
+                             ("Q1 FFT PSD", "Q4 FFT PSD"), ("blue", "purple"),
+                             band, fmin, fmax, f"Post-Stim Protocol {prot_num}: FFT PSD (Q1-Q4)",
+                             os.path.join(pa_dir, f"poststim_protocol_{prot_num}_fft_psd_comparison.png"))
         if logger:
             logger.info(f"Post-Stim Protocol {prot_num}: Welch diff={diff_power:.4f}, FFT diff={diff_power_fft:.4f}, Entropy diff={diff_ent:.4f}")
+    plt.close(fig_welch)
+    plt.close(fig_fft)
 
     # Save protocol-level statistics.
     pd.DataFrame(protocol_stats_stim).to_csv(os.path.join(pa_dir, "protocol_stats_stim.csv"), index=False)
@@ -354,68 +469,55 @@ def plot_average_psd(raw,
                      subject_id=None,
                      condition=None,
                      epoch_type="stim",  # "stim" or "poststim"
-                     logger=None):
+                     logger=None,
+                     data=None,
+                     target_signal=None):
     """
     Computes the average PSD across protocols using Welch.
     For stim: difference = (avg PSD of Q4) - (avg PSD of Q1).
     For poststim: difference = (avg PSD of Q1) - (avg PSD of Q4).
+    data: optional raw.get_data(units='uV') array, so callers can extract it once.
+    target_signal: optional precomputed get_target_signal() output.
     """
     sf = raw.info['sfreq']
-    data = raw.get_data(units='uV')
-    available_indices = [i for i, ch in enumerate(raw.info['ch_names']) if ch in TARGET_CHANNELS]
-    if not available_indices:
-        available_indices = [0]
+    if target_signal is None:
+        target_signal = get_target_signal(raw, data=data)
     fmin, fmax = FMIN, FMAX
     # Use the first band from the list for the average PSD analysis.
     band = ENTRAINMENT_BANDS[0]
     pa_dir = os.path.join(output_dir, "power_analysis")
     os.makedirs(pa_dir, exist_ok=True)
-    all_q1 = [np.mean(data[available_indices, q1_ep[0]:q1_ep[1]], axis=0) for q1_ep in q1_epochs]
-    all_q4 = [np.mean(data[available_indices, q4_ep[0]:q4_ep[1]], axis=0) for q4_ep in q4_epochs]
+    all_q1 = [target_signal[q1_ep[0]:q1_ep[1]] for q1_ep in q1_epochs]
+    all_q4 = [target_signal[q4_ep[0]:q4_ep[1]] for q4_ep in q4_epochs]
     if not all_q1 or not all_q4:
         if logger:
             logger.warning("No valid Q1/Q4 epochs found. Skipping average PSD plot.")
         return
     common_len = min(min(len(x) for x in all_q1), min(len(x) for x in all_q4))
-    cropped_q1 = [x[:common_len] for x in all_q1]
-    cropped_q4 = [x[:common_len] for x in all_q4]
-    psds_q1 = []
-    psds_q4 = []
-    valid_freqs = None
-    for cq1 in cropped_q1:
-        try:
-            n_per_seg = len(cq1) if len(cq1) < FIXED_NFFT else None
-            psd, freqs = psd_array_welch(cq1[np.newaxis, :], sfreq=sf, fmin=fmin, fmax=fmax,
-                                         n_fft=FIXED_NFFT, n_per_seg=n_per_seg, verbose=False)
-            psds_q1.append(psd[0])
-            valid_freqs = freqs
-        except Exception as e:
-            if logger:
-                logger.warning(f"Error computing Welch PSD for a Q1 epoch: {e}.")
-    for cq4 in cropped_q4:
-        try:
-            n_per_seg = len(cq4) if len(cq4) < FIXED_NFFT else None
-            psd, _ = psd_array_welch(cq4[np.newaxis, :], sfreq=sf, fmin=fmin, fmax=fmax,
-                                     n_fft=FIXED_NFFT, n_per_seg=n_per_seg, verbose=False)
-            psds_q4.append(psd[0])
-        except Exception as e:
-            if logger:
-                logger.warning(f"Error computing Welch PSD for a Q4 epoch: {e}.")
-    if not psds_q1 or not psds_q4:
+    # Cropped epochs share one length, so all Q1 and Q4 epochs go through a
+    # single Welch call as rows of one (n_q1 + n_q4, common_len) array.
+    n_q1 = len(all_q1)
+    stacked = np.stack([x[:common_len] for x in all_q1 + all_q4])
+    n_per_seg = common_len if common_len < FIXED_NFFT else None
+    try:
+        psds, valid_freqs = psd_array_welch(stacked, sfreq=sf, fmin=fmin, fmax=fmax,
+                                            n_fft=FIXED_NFFT, n_per_seg=n_per_seg, verbose=False)
+    except Exception as e:
         if logger:
-            logger.warning("No valid Welch PSDs computed. Skipping average PSD plot.")
+            logger.warning(f"Error computing Welch PSD for the Q1/Q4 epochs: {e}. Skipping average PSD plot.")
         return
+    psds_q1, psds_q4 = psds[:n_q1], psds[n_q1:]
     avg_psd_q1 = np.mean(psds_q1, axis=0)
     avg_psd_q4 = np.mean(psds_q4, axis=0)
     diff_psd = (avg_psd_q4 - avg_psd_q1) if epoch_type.lower() == "stim" else (avg_psd_q1 - avg_psd_q4)
-    if logger and valid_freqs is not None and len(valid_freqs) > 1:
+    if logger and len(valid_freqs) > 1:
         freq_res = valid_freqs[1] - valid_freqs[0]
         logger.info(f"Average Welch PSD freq resolution = {freq_res:.6f} Hz (n_fft={FIXED_NFFT})")
     fig, ax = plt.subplots(figsize=(8, 5))
-    ax.plot(valid_freqs, avg_psd_q1, label="Avg Q1 PSD (Welch)", color="orange")
-    ax.plot(valid_freqs, avg_psd_q4, label="Avg Q4 PSD (Welch)", color="red")
+    ax.plot(_f32(valid_freqs), _f32(avg_psd_q1), label="Avg Q1 PSD (Welch)", color="orange")
+    ax.plot(_f32(valid_freqs), _f32(avg_psd_q4), label="Avg Q4 PSD (Welch)", color="red")
     diff_label = "Q4-Q1" if epoch_type.lower() == "stim" else "Q1-Q4"
-    ax.plot(valid_freqs, diff_psd, label=f"Diff ({diff_label}, Welch)", color="blue")
+    ax.plot(_f32(valid_freqs), _f32(diff_psd), label=f"Diff ({diff_label}, Welch)", color="blue")
     ax.axvline(x=1.0, color="green", linestyle="--", label="1 Hz")
     ax.axvspan(band[0], band[1], color="gray", alpha=0.3, label=f"{band[0]}–{band[1]} Hz")
     ax.set_xlabel("Frequency (Hz)")
@@ -425,7 +527,7 @@ def plot_average_psd(raw,
     ax.set_xlim(fmin, fmax)
     fig.tight_layout()
     fname = f"average_psd_q1_vs_q4_{epoch_type}.png"
-    fig.savefig(os.path.join(pa_dir, fname))
+    fig.savefig(os.path.join(pa_dir, fname), dpi=SAVEFIG_DPI)
     plt.close(fig)
     if logger:
         logger.info(f"Saved average Welch PSD plot for {epoch_type} epochs as {fname}.")
@@ -436,98 +538,113 @@ def plot_average_psd(raw,
         "psd_diff": list(diff_psd)
     }])
     csv_path = os.path.join(pa_dir, f"psd_data_{epoch_type}.csv")
-    if os.path.exists(csv_path):
-        df_existing = pd.read_csv(csv_path)
-        df_psd = pd.concat([df_existing, df_psd], ignore_index=True)
-    df_psd.to_csv(csv_path, index=False)
+    # Append the row; the header is only written when the file is new.
+    df_psd.to_csv(csv_path, mode='a', header=not os.path.exists(csv_path), index=False)
     if logger:
         logger.info(f"Saved average Welch PSD CSV data to {csv_path}.")
 
 ###############################################################################
 # 4) TOPOMAP PLOTTING
 ###############################################################################
+def _epoch_topo_psd(q1_block, q4_block, sf, method, fmin, fmax):
+    """
+    Q1/Q4 spectra of all channels for one protocol, as (freqs, psd_q1, psd_q4).
+    FFT spectra are cropped to ENTRAINMENT_SPAN so only the bins the bands use are
+    kept for every protocol. Errors are returned rather than raised so one bad
+    protocol does not stop the parallel run.
+    """
+    try:
+        if method.lower() == "welch":
+            psd_q1, freqs = psd_array_welch(q1_block, sfreq=sf, fmin=fmin, fmax=fmax,
+                                            n_fft=q1_block.shape[1], verbose=False)
+            psd_q4, _ = psd_array_welch(q4_block, sfreq=sf, fmin=fmin, fmax=fmax,
+                                        n_fft=q4_block.shape[1], verbose=False)
+        else:
+            freqs, psd_q1 = _fft_psd(q1_block, sf)
+            _, psd_q4 = _fft_psd(q4_block, sf)
+            # Copy the cropped bins so the full one-sided spectra can be freed
+            lo_i, hi_i = _band_bounds(freqs, *ENTRAINMENT_SPAN)
+            freqs = freqs[lo_i:hi_i]
+            psd_q1 = psd_q1[:, lo_i:hi_i].copy()
+            psd_q4 = psd_q4[:, lo_i:hi_i].copy()
+    except Exception as e:
+        return e
+    return freqs, psd_q1, psd_q4
+
 def plot_topomaps(raw,
                   q1_epochs,
                   q4_epochs,
                   output_dir,
                   epoch_type="stim",  # "stim" or "poststim"
                   method="welch",     # "welch" or "fft"
-                  logger=None):
+                  logger=None,
+                  data=None,
+                  n_jobs=1):
     """
     Computes channel-wise narrow-band power topomaps for each entrainment band.
     For stim: difference = Q4 - Q1; for poststim: difference = Q1 - Q4.
     'method' chooses Welch or FFT.
     A separate figure and CSV file is generated for each band.
+    data: optional raw.get_data(units='uV') array, so callers can extract it once;
+    without it, only the Q1/Q4 blocks are read from raw.
+    n_jobs: number of workers for the per-protocol spectra (mne parallel_func).
     """
     sf = raw.info['sfreq']
-    data = raw.get_data(units='uV')
-    n_channels = data.shape[0]
+    n_channels = len(raw.info["ch_names"])
     channel_names = raw.info["ch_names"]
     fmin, fmax = FMIN, FMAX
     pa_dir = os.path.join(output_dir, "power_analysis")
     os.makedirs(pa_dir, exist_ok=True)
 
+    # Compute every channel's Q1/Q4 spectrum once per protocol (all channels in
+    # one batched call), then reuse the spectra for all entrainment bands.
+    # Protocols are independent, so they are spread over n_jobs workers.
+    parallel, p_fun, _ = parallel_func(_epoch_topo_psd, n_jobs=n_jobs, verbose=False)
+    results = parallel(p_fun(_get_block(raw, data, q1_ep[0], q1_ep[1]),
+                             _get_block(raw, data, q4_ep[0], q4_ep[1]),
+                             sf, method, fmin, fmax)
+                       for q1_ep, q4_ep in zip(q1_epochs, q4_epochs))
+    epoch_psds = []
+    for (_, _, prot_num), res in zip(q1_epochs, results):
+        if isinstance(res, Exception):
+            if logger:
+                logger.warning(f"Protocol {prot_num}: Error computing PSD: {res}")
+            continue
+        epoch_psds.append(res)
+
     # Loop over each entrainment band in the list.
     for band in ENTRAINMENT_BANDS:
         band_label = f"{band[0]}-{band[1]}"
-        q1_topo = np.zeros(n_channels)
-        q4_topo = np.zeros(n_channels)
-        for ch_idx in range(n_channels):
-            vals_q1 = []
-            vals_q4 = []
-            for q1_ep, q4_ep in zip(q1_epochs, q4_epochs):
-                q1_start, q1_end, _ = q1_ep
-                q4_start, q4_end, _ = q4_ep
-                q1_data = data[ch_idx, q1_start:q1_end]
-                q4_data = data[ch_idx, q4_start:q4_end]
-                try:
-                    if method.lower() == "welch":
-                        psd_q1, freqs = psd_array_welch(q1_data[np.newaxis, :],
-                                                        sfreq=sf, fmin=fmin, fmax=fmax,
-                                                        n_fft=len(q1_data), verbose=False)
-                        psd_q4, _ = psd_array_welch(q4_data[np.newaxis, :],
-                                                    sfreq=sf, fmin=fmin, fmax=fmax,
-                                                    n_fft=len(q4_data), verbose=False)
-                        psd_q1 = psd_q1[0]
-                        psd_q4 = psd_q4[0]
-                    else:
-                        N1 = len(q1_data)
-                        fft_vals1 = np.fft.rfft(q1_data)
-                        freqs = np.fft.rfftfreq(N1, d=1/sf)
-                        psd_q1 = (np.abs(fft_vals1)**2) / (sf * N1)
-                        if N1 > 1:
-                            psd_q1[1:-1] *= 2
-                        N4 = len(q4_data)
-                        fft_vals4 = np.fft.rfft(q4_data)
-                        psd_q4 = (np.abs(fft_vals4)**2) / (sf * N4)
-                        if N4 > 1:
-                            psd_q4[1:-1] *= 2
-                except Exception as e:
-                    if logger:
-                        logger.warning(f"Channel {channel_names[ch_idx]}: Error computing PSD: {e}")
-                    continue
-                band_idx = np.where((freqs >= band[0]) & (freqs <= band[1]))[0]
-                if len(band_idx) == 0:
-                    continue
-                vals_q1.append(np.mean(psd_q1[band_idx]))
-                vals_q4.append(np.mean(psd_q4[band_idx]))
-            q1_topo[ch_idx] = np.mean(vals_q1) if vals_q1 else np.nan
-            q4_topo[ch_idx] = np.mean(vals_q4) if vals_q4 else np.nan
+        q1_sum = np.zeros(n_channels)
+        q4_sum = np.zeros(n_channels)
+        n_valid = 0
+        for freqs, psd_q1, psd_q4 in epoch_psds:
+            lo_i, hi_i = _band_bounds(freqs, band[0], band[1])
+            if hi_i == lo_i:
+                continue
+            q1_sum += psd_q1[:, lo_i:hi_i].mean(axis=1)
+            q4_sum += psd_q4[:, lo_i:hi_i].mean(axis=1)
+            n_valid += 1
+        if n_valid:
+            q1_topo = q1_sum / n_valid
+            q4_topo = q4_sum / n_valid
+        else:
+            q1_topo = np.full(n_channels, np.nan)
+            q4_topo = np.full(n_channels, np.nan)
         diff_topo = (q4_topo - q1_topo) if epoch_type.lower() == "stim" else (q1_topo - q4_topo)
-        common_vmin = np.nanmin([np.nanmin(q1_topo), np.nanmin(q4_topo)])
-        common_vmax = np.nanmax([np.nanmax(q1_topo), np.nanmax(q4_topo)])
+        common_vmin, common_vmax = _common_vlim(q1_topo, q4_topo)
         fig, axes = plt.subplots(1, 3, figsize=(15, 5))
-        im0, _ = mne.viz.plot_topomap(q1_topo, raw.info, axes=axes[0], show=False, contours=0,
+        im0, _ = mne.viz.plot_topomap(_f32(q1_topo), raw.info, axes=axes[0], show=False, contours=0,
                                       vlim=(common_vmin, common_vmax), names=channel_names)
         axes[0].set_title("Q1")
         cbar0 = plt.colorbar(im0, ax=axes[0], orientation='vertical', fraction=0.046, pad=0.04)
         cbar0.set_label('Power (uV²/Hz)')
-        im1, _ = mne.viz.plot_topomap(q4_topo, raw.info, axes=axes[1], show=False, contours=0,
+        im1, _ = mne.viz.plot_topomap(_f32(q4_topo), raw.info, axes=axes[1], show=False, contours=0,
                                       vlim=(common_vmin, common_vmax), names=channel_names)
         axes[1].set_title("Q4")
         cbar1 = plt.colorbar(im1, ax=axes[1], orientation='vertical', fraction=0.046, pad=0.04)
         cbar1.set_label('Power (uV²/Hz)')
-        im2, _ = mne.viz.plot_topomap(diff_topo, raw.info, axes=axes[2], show=False, contours=0)
+        im2, _ = mne.viz.plot_topomap(_f32(diff_topo), raw.info, axes=axes[2], show=False, contours=0)
         diff_label = "Q4-Q1" if epoch_type.lower()=="stim" else "Q1-Q4"
         axes[2].set_title(f"Difference ({diff_label})")
         cbar2 = plt.colorbar(im2, ax=axes[2], orientation='vertical', fraction=0.046, pad=0.04)
@@ -535,7 +652,7 @@ def plot_topomaps(raw,
         fig.suptitle(f"{method.upper()} Topomaps ({epoch_type.capitalize()}) for Band {band_label} Hz")
         fig.tight_layout()
         fname = f"topomaps_q1_q4_difference_{epoch_type}_{band_label}_{method}.png"
-        fig.savefig(os.path.join(pa_dir, fname))
+        fig.savefig(os.path.join(pa_dir, fname), dpi=SAVEFIG_DPI)
         plt.close(fig)
         if logger:
             logger.info(f"Saved topomap figures ({method.upper()}) for {epoch_type} epochs for band {band_label} as {fname}.")
@@ -550,3 +667,132 @@ def plot_topomaps(raw,
         if logger:
             logger.info(f"Saved topomap CSV data for band {band_label} to {csv_path}.")
 
+def plot_entropy_topomaps(raw,
+                          q1_epochs,
+                          q4_epochs,
+                          output_dir,
+                          epoch_type="stim",  # "stim" or "poststim"
+                          logger=None,
+                          data=None):
+    """
+    Computes channel-wise permutation entropy topomaps (order 3, normalized),
+    averaged over protocols. For stim: difference = Q4 - Q1; for poststim:
+    difference = Q1 - Q4.
+    Each quarter is passed to antropy as one (n_channels, n_times) array, so
+    all channels are handled by a single vectorized call per epoch.
+    data: optional raw.get_data(units='uV') array, so callers can extract it once;
+    without it, only the Q1/Q4 blocks are read from raw.
+    """
+    n_channels = len(raw.info["ch_names"])
+    channel_names = raw.info["ch_names"]
+    pa_dir = os.path.join(output_dir, "power_analysis")
+    os.makedirs(pa_dir, exist_ok=True)
+
+    q1_sum = np.zeros(n_channels)
+    q4_sum = np.zeros(n_channels)
+    n_valid = 0
+    for q1_ep, q4_ep in zip(q1_epochs, q4_epochs):
+        q1_start, q1_end, prot_num = q1_ep
+        q4_start, q4_end, _ = q4_ep
+        q1_block = _get_block(raw, data, q1_start, q1_end)
+        q4_block = _get_block(raw, data, q4_start, q4_end)
+        try:
+            if q1_block.shape[1] == q4_block.shape[1]:
+                ent = ant.perm_entropy(np.vstack((q1_block, q4_block)), order=3, delay=1, normalize=True)
+                ent_q1, ent_q4 = ent[:n_channels], ent[n_channels:]
+            else:
+                ent_q1 = ant.perm_entropy(q1_block, order=3, delay=1, normalize=True)
+                ent_q4 = ant.perm_entropy(q4_block, order=3, delay=1, normalize=True)
+        except Exception as e:
+            if logger:
+                logger.warning(f"Protocol {prot_num}: Error computing permutation entropy: {e}")
+            continue
+        q1_sum += ent_q1
+        q4_sum += ent_q4
+        n_valid += 1
+    if n_valid:
+        q1_topo = q1_sum / n_valid
+        q4_topo = q4_sum / n_valid
+    else:
+        q1_topo = np.full(n_channels, np.nan)
+        q4_topo = np.full(n_channels, np.nan)
+    diff_topo = (q4_topo - q1_topo) if epoch_type.lower() == "stim" else (q1_topo - q4_topo)
+    common_vmin, common_vmax = _common_vlim(q1_topo, q4_topo)
+    fig, axes = plt.subplots(1, 3, figsize=(15, 5))
+    im0, _ = mne.viz.plot_topomap(_f32(q1_topo), raw.info, axes=axes[0], show=False, contours=0,
+                                  vlim=(common_vmin, common_vmax), names=channel_names)
+    axes[0].set_title("Q1")
+    cbar0 = plt.colorbar(im0, ax=axes[0], orientation='vertical', fraction=0.046, pad=0.04)
+    cbar0.set_label('Permutation Entropy')
+    im1, _ = mne.viz.plot_topomap(_f32(q4_topo), raw.info, axes=axes[1], show=False, contours=0,
+                                  vlim=(common_vmin, common_vmax), names=channel_names)
+    axes[1].set_title("Q4")
+    cbar1 = plt.colorbar(im1, ax=axes[1], orientation='vertical', fraction=0.046, pad=0.04)
+    cbar1.set_label('Permutation Entropy')
+    im2, _ = mne.viz.plot_topomap(_f32(diff_topo), raw.info, axes=axes[2], show=False, contours=0)
+    diff_label = "Q4-Q1" if epoch_type.lower()=="stim" else "Q1-Q4"
+    axes[2].set_title(f"Difference ({diff_label})")
+    cbar2 = plt.colorbar(im2, ax=axes[2], orientation='vertical', fraction=0.046, pad=0.04)
+    cbar2.set_label('Entropy Diff')
+    fig.suptitle(f"Permutation Entropy Topomaps ({epoch_type.capitalize()})")
+    fig.tight_layout()
+    fname = f"topomaps_q1_q4_difference_{epoch_type}_entropy.png"
+    fig.savefig(os.path.join(pa_dir, fname), dpi=SAVEFIG_DPI)
+    plt.close(fig)
+    if logger:
+        logger.info(f"Saved permutation entropy topomaps for {epoch_type} epochs as {fname}.")
+    df_topo = pd.DataFrame({
+        "Channel": channel_names,
+        "Q1 Entropy": q1_topo,
+        "Q4 Entropy": q4_topo,
+        "Difference": diff_topo
+    })
+    csv_path = os.path.join(pa_dir, f"topomap_data_{epoch_type}_entropy.csv")
+    df_topo.to_csv(csv_path, index=False)
+    if logger:
+        logger.info(f"Saved entropy topomap CSV data to {csv_path}.")
+
+###############################################################################
+# 5) FULL POWER ANALYSIS FOR ONE RECORDING
+###############################################################################
+def run_power_analysis(raw, output_dir, subject_id=None, condition=None, logger=None, n_jobs=1):
+    """
+    Runs the protocol analysis, the average PSD plots and the Welch/FFT topomaps
+    (stim and post-stim) on one recording. The data array is extracted from raw
+    once and shared by all steps. n_jobs is passed to plot_topomaps.
+    Returns (pre_stim_epochs, q1_stim_epochs, q4_stim_epochs, post_stim_epochs).
+    """
+    data = raw.get_data(units='uV')
+    target_signal = get_target_signal(raw, data=data, logger=logger)
+    pre_stim_epochs, q1_stim_epochs, q4_stim_epochs, post_stim_epochs = split_stim_epochs(raw, logger=logger)
+
+    # Protocol-by-protocol PSD plots and CSV stats
+    analyze_protocols(raw, pre_stim_epochs, q1_stim_epochs, q4_stim_epochs, post_stim_epochs,
+                      output_dir, subject_id, condition, logger, target_signal=target_signal)
+
+    # Post-stim epochs are compared quarter by quarter
+    q1_post_epochs, q4_post_epochs = [], []
+    for post_epoch in post_stim_epochs:
+        q1_post, q4_post = get_quarters(post_epoch)
+        q1_post_epochs.append(q1_post)
+        q4_post_epochs.append(q4_post)
+
+    # Average PSD plots (stim: Q4 - Q1, poststim: Q1 - Q4)
+    plot_average_psd(raw, q1_stim_epochs, q4_stim_epochs, output_dir,
+                     subject_id, condition, epoch_type="stim", logger=logger,
+                     target_signal=target_signal)
+    plot_average_psd(raw, q1_post_epochs, q4_post_epochs, output_dir,
+                     subject_id, condition, epoch_type="poststim", logger=logger,
+                     target_signal=target_signal)
+
+    # Topoplots (Welch and FFT) for stim and poststim epochs
+    for q1_epochs, q4_epochs, epoch_type in ((q1_stim_epochs, q4_stim_epochs, "stim"),
+                                             (q1_post_epochs, q4_post_epochs, "poststim")):
+        for method in ("welch", "fft"):
+            plot_topomaps(raw, q1_epochs, q4_epochs, output_dir,
+                          epoch_type=epoch_type, method=method, logger=logger, data=data,
+                          n_jobs=n_jobs)
+        plot_entropy_topomaps(raw, q1_epochs, q4_epochs, output_dir,
+                              epoch_type=epoch_type, logger=logger, data=data)
+
+    return pre_stim_epochs, q1_stim_epochs, q4_stim_epochs, post_stim_epochs
@@ -1,26 +1,98 @@
 
 # statistical_analysis.py
 
+import matplotlib
+matplotlib.use('Agg')  # Headless: figures are only written to PNG
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
+import numpy as np
 import os
 import logging
 
 def add_value_labels(ax, spacing=5):
-    """Add labels to the end of each bar in a bar chart."""
-    for rect in ax.patches:
-        y_value = rect.get_height()
-        x_value = rect.get_x() + rect.get_width() / 2
-        label = f"{y_value:.2f}" if y_value != 0 else "0"
-        ax.annotate(
-            label,
-            (x_value, y_value),
-            xytext=(0, spacing),
-            textcoords="offset points",
-            ha='center',
-            va='bottom'
-        )
+    """Add labels to the end of each bar in a bar chart (one bar_label call per bar group)."""
+    for container in ax.containers:
+        ax.bar_label(container, fmt=lambda v: f"{v:.2f}" if v != 0 else "0", padding=spacing)
+
+# Protocols (and region/protocol subsets) with fewer waves than this are not
+# plotted: the bar charts would be almost empty and only cost rendering time.
+# Their waves still count towards the overall and quantification outputs.
+MIN_PROTOCOL_WAVES = 3
+
+MEAN_VALUE_COLORS = ['#6baed6', '#9ecae1', '#c6dbef', '#fd8d3c', '#fdae6b']
+
+def _draw_mean_values(ax, means, title):
+    """Clear ax and draw the grouped bar chart of mean wave properties per classification."""
+    ax.clear()
+    means.plot(kind='bar', ax=ax, color=MEAN_VALUE_COLORS, rot=0)
+    ax.set_title(title)
+    ax.set_ylabel('Mean Values')
+    ax.set_xlabel('Classification', labelpad=10)
+    ax.legend(title='Properties', loc='upper right', bbox_to_anchor=(1.15, 1))
+    add_value_labels(ax)
+    ax.figure.tight_layout()
+
+def _draw_counts(ax, counts, title):
+    """Clear ax and draw the bar chart of wave counts per classification."""
+    ax.clear()
+    counts.plot(kind='bar', ax=ax, color='#6baed6', rot=0)
+    ax.set_title(title)
+    ax.set_ylabel('Count')
+    ax.set_xlabel('Classification', labelpad=10)
+    add_value_labels(ax)
+    ax.figure.tight_layout()
+
+def normalize_classification(labels, classifications):
+    """
+    Format classification labels (lowercase, spaces to hyphens) as an ordered categorical.
+
+    The formatting is done once per distinct label and the codes are remapped.
+    Labels outside classifications are kept as extra categories after them
+    (sorted), so they still show up in the quantification; missing labels stay NaN.
+
+    Parameters:
+    - labels: pd.Series of raw classification labels (e.g. 'Pre Stim', 'stim').
+    - classifications: list of str, the expected labels in plotting order.
+
+    Returns:
+    - pd.Categorical with categories classifications + any extra formatted labels.
+    """
+    raw = pd.Categorical(labels)
+    formatted = raw.categories.str.lower().str.replace(' ', '-')
+    extras = sorted(set(formatted).difference(classifications))
+    categories = list(classifications) + extras
+    remap = np.append(pd.Index(categories).get_indexer(formatted), -1)  # code -1 (NaN) stays -1
+    return pd.Categorical.from_codes(remap[raw.codes], categories=categories, ordered=True)
+
+def quantify_waves(df):
+    """
+    Number of waves and amplitude (PTP) statistics per protocol and stage.
+
+    The groupby runs on the original column names and computes all five
+    statistics from one factorization of the keys; only the small result is
+    renamed (Protocol_Number, Stage), so the input frame is never copied.
+
+    Parameters:
+    - df: pd.DataFrame with 'Protocol Number', 'Classification' and 'PTP' columns.
+
+    Returns:
+    - pd.DataFrame with Protocol_Number, Stage, Number_of_Waves, Average_Amplitude,
+      Max_Amplitude, Min_Amplitude and Std_Amplitude (rounded to two decimals).
+    """
+    quantification = df.groupby(['Protocol Number', 'Classification'], observed=True)['PTP'].agg(
+        Number_of_Waves='count',
+        Average_Amplitude='mean',
+        Max_Amplitude='max',
+        Min_Amplitude='min',
+        Std_Amplitude='std'
+    )
+    # Handle NaN in std (e.g., if only one wave in a group)
+    quantification['Std_Amplitude'] = quantification['Std_Amplitude'].fillna(0)
+    # Round to two decimal places
+    stat_cols = ['Average_Amplitude', 'Max_Amplitude', 'Min_Amplitude', 'Std_Amplitude']
+    quantification[stat_cols] = quantification[stat_cols].round(2)
+    return quantification.rename_axis(['Protocol_Number', 'Stage']).reset_index()
 
 def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject, night, suffix=''):
     """
@@ -36,7 +108,6 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
     - night: str, night identifier.
     - suffix: str, additional suffix to differentiate output files.
     """
- 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -47,14 +118,21 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
     columns_to_plot = ['Duration', 'ValNegPeak', 'ValPosPeak', 'PTP', 'Frequency']
     all_classifications = ['pre-stim', 'stim', 'post-stim']
 
-    # Ensure Classification column is properly formatted (lowercase, hyphenated)
-    df_filtered['Classification'] = df_filtered['Classification'].str.lower().str.replace(' ', '-')
+    # Format Classification (lowercase, hyphenated) as a categorical on a copy, so groupby and
+    # value_counts work on codes and the caller's frame is left untouched
+    df_filtered = df_filtered.assign(
+        Classification=normalize_classification(df_filtered['Classification'], all_classifications)
+    )
+
+    # One figure per plot type, cleared and redrawn for every bar plot
+    fig_means, ax_means = plt.subplots(figsize=(15, 6))
+    fig_counts, ax_counts = plt.subplots(figsize=(8, 6))
 
     # === 1) OVERALL (ENTIRE NET) STATISTICS ===
     # Compute mean values by Classification
     comparison_means = (
         df_filtered
-        .groupby('Classification')[columns_to_plot]
+        .groupby('Classification', observed=True)[columns_to_plot]
         .mean()
         .reindex(all_classifications, fill_value=0)
     )
@@ -66,77 +144,41 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
     )
 
     # --- Plotting overall mean values ---
-    plt.figure(figsize=(15, 6))
-    ax = comparison_means.plot(kind='bar', 
-                               color=['#6baed6', '#9ecae1', '#c6dbef', '#fd8d3c', '#fdae6b'])
-    plt.title(f'Overall Mean Values of Wave Properties ({suffix})')
-    plt.ylabel('Mean Values')
-    plt.xlabel('Classification', labelpad=10)
-    plt.xticks(rotation=0)
-    plt.legend(title='Properties', loc='upper right', bbox_to_anchor=(1.15, 1))
-    add_value_labels(ax)
-    plt.tight_layout()
+    _draw_mean_values(ax_means, comparison_means, f'Overall Mean Values of Wave Properties ({suffix})')
     overall_mean_png = os.path.join(wave_description_dir, f'overall_mean_values_{suffix}.png')
-    plt.savefig(overall_mean_png)
-    plt.close()
+    fig_means.savefig(overall_mean_png)
 
     # --- Plotting overall counts ---
-    plt.figure(figsize=(8, 6))
-    ax2 = comparison_counts.plot(kind='bar', color='#6baed6')
-    plt.title(f'Overall Count of Instances by Classification ({suffix})')
-    plt.ylabel('Count')
-    plt.xlabel('Classification', labelpad=10)
-    plt.xticks(rotation=0)
-    add_value_labels(ax2)
-    plt.tight_layout()
+    _draw_counts(ax_counts, comparison_counts, f'Overall Count of Instances by Classification ({suffix})')
     overall_counts_png = os.path.join(wave_description_dir, f'overall_counts_{suffix}.png')
-    plt.savefig(overall_counts_png)
-    plt.close()
+    fig_counts.savefig(overall_counts_png)
 
     # === 2) PER-PROTOCOL STATISTICS (ENTIRE NET) ===
     protocol_numbers = df_filtered['Protocol Number'].dropna().unique()
 
+    # One groupby over all protocols, reindexed so every (protocol, classification) pair
+    # is present and each protocol can be sliced with .loc; only empty pairs are filled with 0
+    protocol_index = pd.MultiIndex.from_product([protocol_numbers, all_classifications])
+    protocol_groups = df_filtered.groupby(['Protocol Number', 'Classification'], observed=True)
+    all_protocol_means = protocol_groups[columns_to_plot].mean().reindex(protocol_index, fill_value=0)
+    all_protocol_counts = protocol_groups.size().reindex(protocol_index, fill_value=0)
+
     for protocol in protocol_numbers:
-        protocol_data = df_filtered[df_filtered['Protocol Number'] == protocol]
-        protocol_means = (
-            protocol_data
-            .groupby('Classification')[columns_to_plot]
-            .mean()
-            .reindex(all_classifications, fill_value=0)
-        )
-        protocol_counts = (
-            protocol_data['Classification']
-            .value_counts()
-            .reindex(all_classifications, fill_value=0)
-        )
+        protocol_means = all_protocol_means.loc[protocol]
+        protocol_counts = all_protocol_counts.loc[protocol]
+        if protocol_counts.sum() < MIN_PROTOCOL_WAVES:
+            logging.info(f"Skipping plots for protocol {int(protocol)} (insufficient data)")
+            continue
 
         # --- Plot mean values per protocol ---
-        plt.figure(figsize=(15, 6))
-        ax = protocol_means.plot(kind='bar', 
-                                 color=['#6baed6', '#9ecae1', '#c6dbef', '#fd8d3c', '#fdae6b'])
-        plt.title(f'Mean Values of Wave Properties (Protocol {int(protocol)}, {suffix})')
-        plt.ylabel('Mean Values')
-        plt.xlabel('Classification', labelpad=10)
-        plt.xticks(rotation=0)
-        plt.legend(title='Properties', loc='upper right', bbox_to_anchor=(1.15, 1))
-        add_value_labels(ax)
-        plt.tight_layout()
+        _draw_mean_values(ax_means, protocol_means, f'Mean Values of Wave Properties (Protocol {int(protocol)}, {suffix})')
         protocol_mean_png = os.path.join(wave_description_dir, f'protocol_{int(protocol)}_mean_values_{suffix}.png')
-        plt.savefig(protocol_mean_png)
-        plt.close()
+        fig_means.savefig(protocol_mean_png)
 
         # --- Plot counts per protocol ---
-        plt.figure(figsize=(8, 6))
-        ax2 = protocol_counts.plot(kind='bar', color='#6baed6')
-        plt.title(f'Count of Instances by Classification (Protocol {int(protocol)}, {suffix})')
-        plt.ylabel('Count')
-        plt.xlabel('Classification', labelpad=10)
-        plt.xticks(rotation=0)
-        add_value_labels(ax2)
-        plt.tight_layout()
+        _draw_counts(ax_counts, protocol_counts, f'Count of Instances by Classification (Protocol {int(protocol)}, {suffix})')
         protocol_counts_png = os.path.join(wave_description_dir, f'protocol_{int(protocol)}_counts_{suffix}.png')
-        plt.savefig(protocol_counts_png)
-        plt.close()
+        fig_counts.savefig(protocol_counts_png)
 
     # === 3) WAVE QUANTIFICATION (ENTIRE NET) ===
     logging.info("Quantifying waves per protocol per stage (entire net)...")
@@ -146,31 +188,8 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
         if missing_columns:
             raise ValueError(f"Missing required columns in df_filtered: {', '.join(missing_columns)}")
 
-        # Rename for consistency
-        df_quant = df_filtered.rename(columns={
-            'Protocol Number': 'Protocol_Number',
-            'Classification': 'Stage',
-            'PTP': 'Amplitude'
-        })
-
-        # Group by Protocol_Number and Stage
-        grouped = df_quant.groupby(['Protocol_Number', 'Stage'])
-
         # Quantify number of waves and compute amplitude statistics
-        quantification = grouped['Amplitude'].agg(
-            Number_of_Waves='count',
-            Average_Amplitude='mean',
-            Max_Amplitude='max',
-            Min_Amplitude='min',
-            Std_Amplitude='std'
-        ).reset_index()
-
-        # Handle NaN in std (e.g., if only one wave in a group)
-        quantification['Std_Amplitude'] = quantification['Std_Amplitude'].fillna(0)
-
-        # Round to two decimal places
-        for col in ['Average_Amplitude', 'Max_Amplitude', 'Min_Amplitude', 'Std_Amplitude']:
-            quantification[col] = quantification[col].round(2)
+        quantification = quantify_waves(df_filtered)
 
         # Output CSV path for entire net
         quant_csv_path = os.path.join(output_dir, 'wave_quantification.csv')
@@ -179,6 +198,8 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
 
     except Exception as e:
         logging.error(f"Error in quantifying waves (entire net): {e}")
+        plt.close(fig_means)
+        plt.close(fig_counts)
         return  # Exit the function if errors occur
 
     # === 4) APPEND ENTIRE-NET RESULTS TO group_summary.csv ===
@@ -188,37 +209,17 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
         os.makedirs(group_analysis_dir, exist_ok=True)
 
         group_summary_csv = os.path.join(group_analysis_dir, 'group_summary.csv')
-        # Create or load existing group_summary.csv
-        if not os.path.exists(group_summary_csv):
-            columns = [
-                'Subject', 'Night', 'Protocol_Number', 'Stage', 'Number_of_Waves',
-                'Average_Amplitude', 'Max_Amplitude', 'Min_Amplitude', 'Std_Amplitude'
-            ]
-            group_summary_df = pd.DataFrame(columns=columns)
-        else:
-            group_summary_df = pd.read_csv(group_summary_csv)
-
-        # Read the new quantification CSV
-        if not os.path.exists(quant_csv_path):
-            logging.warning(f"Quantification CSV not found at {quant_csv_path}. "
-                            f"Skipping append for Subject: {subject}, Night: {night}.")
-        else:
-            quant_df = pd.read_csv(quant_csv_path)
-            # Add Subject and Night columns
-            quant_df['Subject'] = subject
-            quant_df['Night'] = night
-            # Reorder columns
-            cols = ['Subject', 'Night'] + [c for c in quant_df.columns if c not in ['Subject', 'Night']]
-            quant_df = quant_df[cols]
-
-            # Merge with existing group_summary
-            if not group_summary_df.empty and not quant_df.empty:
-                group_summary_df = pd.concat([group_summary_df, quant_df], ignore_index=True, sort=False)
-            elif group_summary_df.empty and not quant_df.empty:
-                group_summary_df = quant_df.copy()
-
-            group_summary_df.to_csv(group_summary_csv, index=False)
-            logging.info(f"Appended entire-net data to group_summary.csv in {group_analysis_dir}")
+
+        # Use the in-memory quantification rather than re-reading wave_quantification.csv,
+        # with Subject and Night as the leading columns
+        quant_df = quantification.copy()
+        quant_df.insert(0, 'Night', night)
+        quant_df.insert(0, 'Subject', subject)
+
+        # Append this subject's rows; the header is only written when the file is new
+        quant_df.to_csv(group_summary_csv, mode='a',
+                        header=not os.path.exists(group_summary_csv), index=False)
+        logging.info(f"Appended entire-net data to group_summary.csv in {group_analysis_dir}")
 
     except Exception as e:
         logging.error(f"Error appending entire-net data to group_summary.csv: {e}")
@@ -241,7 +242,7 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
         # --- (A) Region-Level Means and Counts ---
         region_means = (
             region_data
-            .groupby('Classification')[columns_to_plot]
+            .groupby('Classification', observed=True)[columns_to_plot]
             .mean()
             .reindex(all_classifications, fill_value=0)
         )
@@ -252,34 +253,14 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
         )
 
         # Plot region-level means
-        plt.figure(figsize=(15, 6))
-        ax_region_means = region_means.plot(
-            kind='bar',
-            color=['#6baed6', '#9ecae1', '#c6dbef', '#fd8d3c', '#fdae6b']
-        )
-        plt.title(f'{region}: Mean Values of Wave Properties ({suffix})')
-        plt.ylabel('Mean Values')
-        plt.xlabel('Classification', labelpad=10)
-        plt.xticks(rotation=0)
-        plt.legend(title='Properties', loc='upper right', bbox_to_anchor=(1.15, 1))
-        add_value_labels(ax_region_means)
-        plt.tight_layout()
+        _draw_mean_values(ax_means, region_means, f'{region}: Mean Values of Wave Properties ({suffix})')
         region_mean_png = os.path.join(wave_description_dir, f'region_{region}_mean_values_{suffix}.png')
-        plt.savefig(region_mean_png)
-        plt.close()
+        fig_means.savefig(region_mean_png)
 
         # Plot region-level counts
-        plt.figure(figsize=(8, 6))
-        ax_region_counts = region_counts.plot(kind='bar', color='#6baed6')
-        plt.title(f'{region}: Count of Instances by Classification ({suffix})')
-        plt.ylabel('Count')
-        plt.xlabel('Classification', labelpad=10)
-        plt.xticks(rotation=0)
-        add_value_labels(ax_region_counts)
-        plt.tight_layout()
+        _draw_counts(ax_counts, region_counts, f'{region}: Count of Instances by Classification ({suffix})')
         region_counts_png = os.path.join(wave_description_dir, f'region_{region}_counts_{suffix}.png')
-        plt.savefig(region_counts_png)
-        plt.close()
+        fig_counts.savefig(region_counts_png)
 
         # --- (B) Region-Level Per-Protocol Statistics ---
         region_protocols = region_data['Protocol Number'].dropna().unique()
@@ -287,7 +268,7 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
             rp_data = region_data[region_data['Protocol Number'] == protocol]
             rp_means = (
                 rp_data
-                .groupby('Classification')[columns_to_plot]
+                .groupby('Classification', observed=True)[columns_to_plot]
                 .mean()
                 .reindex(all_classifications, fill_value=0)
             )
@@ -296,42 +277,25 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
                 .value_counts()
                 .reindex(all_classifications, fill_value=0)
             )
+            if rp_counts.sum() < MIN_PROTOCOL_WAVES:
+                logging.info(f"Skipping plots for {region}, protocol {int(protocol)} (insufficient data)")
+                continue
 
             # Plot region+protocol mean values
-            plt.figure(figsize=(15, 6))
-            ax_rp_means = rp_means.plot(
-                kind='bar',
-                color=['#6baed6', '#9ecae1', '#c6dbef', '#fd8d3c', '#fdae6b']
-            )
-            plt.title(f'{region}: Mean Values (Protocol {int(protocol)}, {suffix})')
-            plt.ylabel('Mean Values')
-            plt.xlabel('Classification', labelpad=10)
-            plt.xticks(rotation=0)
-            plt.legend(title='Properties', loc='upper right', bbox_to_anchor=(1.15, 1))
-            add_value_labels(ax_rp_means)
-            plt.tight_layout()
+            _draw_mean_values(ax_means, rp_means, f'{region}: Mean Values (Protocol {int(protocol)}, {suffix})')
             rp_means_png = os.path.join(
                 wave_description_dir, 
                 f'region_{region}_protocol_{int(protocol)}_mean_values_{suffix}.png'
             )
-            plt.savefig(rp_means_png)
-            plt.close()
+            fig_means.savefig(rp_means_png)
 
             # Plot region+protocol counts
-            plt.figure(figsize=(8, 6))
-            ax_rp_counts = rp_counts.plot(kind='bar', color='#6baed6')
-            plt.title(f'{region}: Count of Instances (Protocol {int(protocol)}, {suffix})')
-            plt.ylabel('Count')
-            plt.xlabel('Classification', labelpad=10)
-            plt.xticks(rotation=0)
-            add_value_labels(ax_rp_counts)
-            plt.tight_layout()
+            _draw_counts(ax_counts, rp_counts, f'{region}: Count of Instances (Protocol {int(protocol)}, {suffix})')
             rp_counts_png = os.path.join(
                 wave_description_dir, 
                 f'region_{region}_protocol_{int(protocol)}_counts_{suffix}.png'
             )
-            plt.savefig(rp_counts_png)
-            plt.close()
+            fig_counts.savefig(rp_counts_png)
 
         # --- (C) Region-Level Wave Quantification ---
         logging.info(f"Quantifying waves for region: {region}")
@@ -341,31 +305,8 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
             if missing_cols:
                 raise ValueError(f"Missing required columns in region_data: {', '.join(missing_cols)}")
 
-            # Rename for consistency
-            df_region_quant = region_data.rename(columns={
-                'Protocol Number': 'Protocol_Number',
-                'Classification': 'Stage',
-                'PTP': 'Amplitude'
-            })
-
-            # Group by Protocol_Number and Stage
-            grouped_region = df_region_quant.groupby(['Protocol_Number', 'Stage'])
-
             # Quantify number of waves and compute amplitude statistics
-            region_quantification = grouped_region['Amplitude'].agg(
-                Number_of_Waves='count',
-                Average_Amplitude='mean',
-                Max_Amplitude='max',
-                Min_Amplitude='min',
-                Std_Amplitude='std'
-            ).reset_index()
-
-            # Handle NaN in std
-            region_quantification['Std_Amplitude'] = region_quantification['Std_Amplitude'].fillna(0)
-
-            # Round to two decimal places
-            for col in ['Average_Amplitude', 'Max_Amplitude', 'Min_Amplitude', 'Std_Amplitude']:
-                region_quantification[col] = region_quantification[col].round(2)
+            region_quantification = quantify_waves(region_data)
 
             # Output CSV path for this region
             region_quant_csv = os.path.join(output_dir, f'wave_quantification_{region}.csv')
@@ -376,5 +317,7 @@ def perform_statistical_analysis(df_filtered, output_dir, project_dir, subject,
             logging.error(f"Error in region-based quantification for {region}: {e}")
             # Continue to next region
 
+    plt.close(fig_means)
+    plt.close(fig_counts)
     logging.info("Region-based analysis completed.")
 
@@ -0,0 +1,15 @@
+# conftest.py
+
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')  # Headless: the modules under test only save figures
+
+# The pipeline modules are imported by name from SW-detect/ (as main.py does)
+SW_DETECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SW_DETECT_DIR)
+sys.path.insert(0, os.path.join(SW_DETECT_DIR, 'group_comparison'))
+
+# Manual scripts kept in this folder, not pytest tests
+collect_ignore = ['test_power.py', 'PTP.py']
@@ -0,0 +1,34 @@
+# test_epoch_creation.py
+
+import numpy as np
+
+from epoch_creation import _build_epochs
+
+def test_build_epochs_without_overlap():
+    onsets = np.array([100.0, 110.0, 200.0, 220.0])
+    orig_pre, stim, orig_post, pre, post, overlaps = _build_epochs(onsets)
+
+    np.testing.assert_array_equal(stim, [[100, 110, 1], [200, 220, 2]])
+    np.testing.assert_array_equal(orig_pre, [[90, 100, 1], [180, 200, 2]])
+    np.testing.assert_array_equal(orig_post, [[110, 120, 1], [220, 240, 2]])
+    np.testing.assert_array_equal(pre, orig_pre)
+    np.testing.assert_array_equal(post, orig_post)
+    np.testing.assert_array_equal(overlaps, [0, 0])
+
+def test_build_epochs_splits_overlap():
+    # Post-stim of protocol 1 ends at 140, pre-stim of protocol 2 starts at 120
+    onsets = np.array([100.0, 120.0, 130.0, 140.0, 999.0])
+    orig_pre, stim, orig_post, pre, post, overlaps = _build_epochs(onsets)
+
+    # The trailing unpaired onset is ignored
+    assert stim.shape == (2, 3)
+    np.testing.assert_array_equal(overlaps, [0, 20])
+    np.testing.assert_array_equal(pre[1], [130, 130, 2])
+    np.testing.assert_array_equal(post[0], [120, 130, 1])
+    np.testing.assert_array_equal(stim, [[100, 120, 1], [130, 140, 2]])
+
+def test_build_epochs_without_protocols():
+    for onsets in (np.array([]), np.array([5.0])):
+        orig_pre, stim, orig_post, pre, post, overlaps = _build_epochs(onsets)
+        assert stim.shape == (0, 3)
+        assert overlaps.shape == (0,)
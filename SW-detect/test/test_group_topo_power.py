@@ -0,0 +1,32 @@
+# test_group_topo_power.py
+
+import numpy as np
+import pandas as pd
+
+from group_topo_power import combine_subjects
+
+def _subject(channels, values):
+    values = np.asarray(values, dtype=float)
+    return pd.DataFrame({'Channel': channels, 'Q1': values, 'Q4': 2 * values, 'Diff': values})
+
+def test_combine_subjects_averages_per_channel():
+    subjects = [
+        _subject(['E1', 'E2'], [1.0, 2.0]),
+        _subject(['E2', 'E3'], [4.0, 6.0]),
+    ]
+    combined = combine_subjects(subjects)
+
+    # Channels in first-seen order; each averaged over the subjects that have it
+    assert list(combined['Channel']) == ['E1', 'E2', 'E3']
+    np.testing.assert_allclose(combined['Q1'], [1.0, 3.0, 6.0])
+    np.testing.assert_allclose(combined['Q4'], [2.0, 6.0, 12.0])
+
+def test_combine_subjects_drops_invalid_channels():
+    subjects = [
+        _subject(['E1', 'E2'], [1.0, 2.0]),
+        _subject(['E1', 'E9'], [3.0, 5.0]),
+    ]
+    combined = combine_subjects(subjects, valid_channels={'E1', 'E2'})
+
+    assert list(combined['Channel']) == ['E1', 'E2']
+    np.testing.assert_allclose(combined['Q1'], [2.0, 2.0])
@@ -0,0 +1,52 @@
+# test_statistical_analysis.py
+
+import numpy as np
+import pandas as pd
+
+from statistical_analysis import normalize_classification, perform_statistical_analysis
+
+CLASSIFICATIONS = ['pre-stim', 'stim', 'post-stim']
+
+def test_normalize_classification_formats_labels():
+    labels = pd.Series(['Pre Stim', 'STIM', 'post stim', 'pre-stim', 'Post-Stim'])
+    result = normalize_classification(labels, CLASSIFICATIONS)
+
+    assert list(result.categories) == CLASSIFICATIONS
+    assert result.ordered
+    assert list(result) == ['pre-stim', 'stim', 'post-stim', 'pre-stim', 'post-stim']
+
+def test_normalize_classification_keeps_unknown_labels():
+    labels = pd.Series(['stim', 'Wake Period', None, 'pre stim'])
+    result = normalize_classification(labels, CLASSIFICATIONS)
+
+    # Unknown labels are formatted too and kept after the expected classes
+    assert list(result.categories) == CLASSIFICATIONS + ['wake-period']
+    assert list(result[[0, 1, 3]]) == ['stim', 'wake-period', 'pre-stim']
+    assert pd.isna(result[2])
+
+def test_perform_statistical_analysis_keeps_input_and_unknown_stages(tmp_path):
+    n = 12
+    df = pd.DataFrame({
+        'Classification': ['Pre Stim', 'stim', 'Post Stim', 'Other'] * (n // 4),
+        'Region_Classification': ['Frontal'] * n,
+        'Protocol Number': [1.0] * n,
+        'Duration': np.linspace(0.5, 1.5, n),
+        'ValNegPeak': -np.linspace(40, 80, n),
+        'ValPosPeak': np.linspace(10, 40, n),
+        'PTP': np.linspace(60, 120, n),
+        'Frequency': np.linspace(0.5, 2.0, n),
+    })
+    original = df.copy()
+
+    perform_statistical_analysis(df, str(tmp_path / 'out'), str(tmp_path), 'S1', 'N1', suffix='test')
+
+    # The caller's frame is not modified
+    pd.testing.assert_frame_equal(df, original)
+
+    quantification = pd.read_csv(tmp_path / 'out' / 'wave_quantification.csv')
+    assert list(quantification['Stage']) == CLASSIFICATIONS + ['other']
+    assert quantification['Number_of_Waves'].sum() == n
+
+    summary = pd.read_csv(tmp_path / 'Group_Analysis' / 'group_summary.csv')
+    assert list(summary.columns[:2]) == ['Subject', 'Night']
+    assert len(summary) == len(quantification)
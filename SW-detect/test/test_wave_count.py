@@ -0,0 +1,22 @@
+# test_wave_count.py
+
+import pandas as pd
+
+from wave_count import aggregate_wave_counts
+
+def test_aggregate_wave_counts_sums_per_region_subject_stage():
+    df = pd.DataFrame({
+        'Region': ['Frontal', 'Frontal', 'Frontal', 'Parietal'],
+        'Subject': ['101', '101', '102', '101'],
+        'Stage': ['stim', 'stim', 'pre-stim', 'stim'],
+        'Protocol_Number': [1, 2, 1, 1],
+        'Number_of_Waves': [3, 4, 5, 6],
+    })
+    counts = aggregate_wave_counts(df)
+
+    assert list(counts.columns) == ['Region', 'Subject', 'Stage', 'Number_of_Waves']
+    assert counts.values.tolist() == [
+        ['Frontal', '101', 'stim', 7],
+        ['Frontal', '102', 'pre-stim', 5],
+        ['Parietal', '101', 'stim', 6],
+    ]